@@ -1,61 +1,127 @@
+import asyncio
+
 import discord
-from discord.ext import commands
 import music_cog
 
+
+class InteractionContext:
+    """The parts of a commands.Context the cog's actions use, built from a button interaction."""
+
+    def __init__(self, interaction: discord.Interaction):
+        self.bot = interaction.client
+        self.guild = interaction.guild
+        self.author = interaction.user
+        self.channel = interaction.channel
+        # what the loop watchdog reports if the press blocks the loop
+        asyncio.current_task().set_name(f"button in guild {self.guild.id}")
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+
 class PrevTrackButton(discord.ui.Button):
-    def __init__(self, cog: "Music", ctx: commands.Context, label, style, custom_id):
+    def __init__(self, cog: "Music", label, style, custom_id):
         super().__init__(label=label, style=style, custom_id=custom_id)
         self.cog = cog
-        self.ctx = ctx
 
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        await self.cog.action_previous(self.ctx, True)
+        await self.cog.action_previous(InteractionContext(interaction), True)
 
 class NextTrackButton(discord.ui.Button):
-    def __init__(self, cog: "Music", ctx: commands.Context, label, style, custom_id):
+    def __init__(self, cog: "Music", label, style, custom_id):
         super().__init__(label=label, style=style, custom_id=custom_id)
         self.cog = cog
-        self.ctx = ctx
 
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        await self.cog.action_skip(self.ctx, True)
+        await self.cog.action_skip(InteractionContext(interaction), True)
 
 class PauseResumeTrackButton(discord.ui.Button):
-    def __init__(self, cog: "Music", ctx: commands.Context, label, style, custom_id):
+    def __init__(self, cog: "Music", label, style, custom_id):
         super().__init__(label=label, style=style, custom_id=custom_id)
         self.cog = cog
-        self.ctx = ctx
 
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        vc = self.ctx.voice_client
+        ctx = InteractionContext(interaction)
+        vc = ctx.voice_client
         if not vc:
             return
 
         if vc.is_playing():
-            await self.cog.action_pause(self.ctx, True)
+            await self.cog.action_pause(ctx, True)
         else:
-            await self.cog.action_resume(self.ctx, True)
+            await self.cog.action_resume(ctx, True)
 
 class ClearQueueButton(discord.ui.Button):
-    def __init__(self, cog: "Music", ctx: commands.Context, label, style, custom_id):
+    def __init__(self, cog: "Music", label, style, custom_id):
         super().__init__(label=label, style=style, custom_id=custom_id)
         self.cog = cog
-        self.ctx = ctx
 
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        await self.cog.action_clear(self.ctx, True)
+        await self.cog.action_clear(InteractionContext(interaction), True)
 
 
 class LeaveButton(discord.ui.Button):
-    def __init__(self, cog: "Music", ctx: commands.Context, label, style, custom_id):
+    def __init__(self, cog: "Music", label, style, custom_id):
         super().__init__(label=label, style=style, custom_id=custom_id)
         self.cog = cog
-        self.ctx = ctx
 
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        await self.cog.action_leave(self.ctx, True)
\ No newline at end of file
+        await self.cog.action_leave(InteractionContext(interaction), True)
+
+
+class PlayerView(discord.ui.View):
+    """Buttons of the player message. Persistent (no timeout, fixed custom_ids) and
+    not tied to a message or a ctx, so one instance per play/pause state serves every
+    player message, and registered with bot.add_view they keep working after a restart."""
+
+    def __init__(self, cog: "Music", paused: bool):
+        super().__init__(timeout=None)
+        self.add_item(PrevTrackButton(cog, "⏮️", discord.ButtonStyle.secondary, "prev_track"))
+        if paused:
+            self.add_item(PauseResumeTrackButton(cog, "▶️", discord.ButtonStyle.success, "pp_track"))
+        else:
+            self.add_item(PauseResumeTrackButton(cog, "⏸️", discord.ButtonStyle.primary, "pp_track"))
+        self.add_item(NextTrackButton(cog, "⏭️", discord.ButtonStyle.secondary, "next_track"))
+        self.add_item(ClearQueueButton(cog, "🚫", discord.ButtonStyle.secondary, "clear_queue"))
+        self.add_item(LeaveButton(cog, "☠️", discord.ButtonStyle.secondary, "leave"))
+
+
+class QueuePageButton(discord.ui.DynamicItem[discord.ui.Button], template=r"queue_page:(?P<page>\d+)"):
+    """Button of a ]queue message that shows another page. The page is in the custom_id,
+    so once registered with bot.add_dynamic_items it works on any ]queue message,
+    including ones sent before a restart, without storing a view per message."""
+
+    def __init__(self, page: int, label, disabled=False):
+        super().__init__(
+            discord.ui.Button(label=label, style=discord.ButtonStyle.secondary, custom_id=f"queue_page:{page}", disabled=disabled)
+        )
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(int(match["page"]), item.label)
+
+    async def callback(self, interaction: discord.Interaction):
+        cog = interaction.client.get_cog("Music")
+        session = cog.guild_session(interaction.guild)
+        if not session:
+            await interaction.response.defer()
+            return
+        embed, view = cog.render_queue_page(session, self.page)
+        await interaction.response.edit_message(embed=embed, view=view)
+
+
+class QueuePageView(discord.ui.View):
+    def __init__(self, page: int, pages: int):
+        super().__init__(timeout=None)
+        self.add_item(QueuePageButton(page - 1, "◀️", disabled=page <= 1))
+        self.add_item(QueuePageButton(page + 1, "▶️", disabled=page >= pages))
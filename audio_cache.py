@@ -0,0 +1,204 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from player import FRAME_SECONDS
+
+# Each packet is stored as its length followed by its bytes
+PACKET_HEADER = struct.Struct("<H")
+SUFFIX = ".opus-packets"
+PART_SUFFIX = ".part"
+# A recording shorter than this share of the track's duration was cut short, not kept
+MIN_COMPLETE = 0.9
+
+
+class CachedTrack:
+    """Audio source reading back the Opus packets of a cached track, no FFmpeg involved."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb", buffering=64 * 1024)
+
+    def read(self):
+        header = self.file.read(PACKET_HEADER.size)
+        if len(header) < PACKET_HEADER.size:
+            return b""
+        (size,) = PACKET_HEADER.unpack(header)
+        return self.file.read(size)
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.file.close()
+
+
+class CacheRecorder:
+    """Writes the packets of a track while it plays, on the audio thread. The file only
+    becomes a cache entry if the track played (nearly) to the end, see finish()."""
+
+    def __init__(self, cache, video_id, duration):
+        self.cache = cache
+        self.video_id = video_id
+        self.duration = duration
+        self.path = os.path.join(cache.path, video_id + PART_SUFFIX)
+        self.file = open(self.path, "wb", buffering=64 * 1024)
+        self.frames = 0
+        self.size = 0
+
+    def write(self, packet):
+        if self.file is None:
+            return
+        if self.size + len(packet) > self.cache.max_entry_bytes:
+            # a stream this long would push everything else out
+            self.abort()
+            return
+        self.file.write(PACKET_HEADER.pack(len(packet)))
+        self.file.write(packet)
+        self.frames += 1
+        self.size += PACKET_HEADER.size + len(packet)
+
+    def finish(self):
+        """The stream ended by itself: keep the recording if it's complete."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.frames and (not self.duration or self.frames * FRAME_SECONDS >= self.duration * MIN_COMPLETE):
+            self.cache._commit(self.video_id, self.path, self.size)
+        else:
+            self.cache._discard(self.video_id, self.path)
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.cache._discard(self.video_id, self.path)
+
+
+class AudioCache:
+    """On-disk cache of the Opus packets of played tracks, keyed by YouTube video id.
+
+    A track is recorded the first time it plays (the packets Discord gets are written
+    as they go through) and later plays read it back from disk, without extraction,
+    network or FFmpeg. The total size is kept under `max_bytes` by evicting the least
+    recently played tracks. Used from the event loop and the audio threads, hence the lock.
+    A `max_bytes` of 0 disables the cache."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 8
+        # video_id -> size in bytes, least recently played first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.recording = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if max_bytes > 0:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    def _load(self):
+        files = []
+        for name in os.listdir(self.path):
+            full = os.path.join(self.path, name)
+            if name.endswith(PART_SUFFIX):
+                # recording interrupted by a restart
+                os.remove(full)
+            elif name.endswith(SUFFIX):
+                stat = os.stat(full)
+                files.append((stat.st_mtime, name[:-len(SUFFIX)], stat.st_size))
+        for _, video_id, size in sorted(files):
+            self.entries[video_id] = size
+            self.size += size
+        self._evict()
+
+    def _file(self, video_id):
+        return os.path.join(self.path, video_id + SUFFIX)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            video_id, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._file(video_id))
+            except OSError as e:
+                print("audio cache error:", e)
+
+    def __contains__(self, video_id):
+        """Membership test that doesn't count as a hit or a miss."""
+        return video_id in self.entries
+
+    def open(self, video_id):
+        """A CachedTrack playing the video from disk, or None if it isn't cached."""
+        if not video_id or self.max_bytes <= 0:
+            return None
+        with self.lock:
+            if video_id not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(video_id)
+            self.hits += 1
+        path = self._file(video_id)
+        try:
+            track = CachedTrack(path)
+            # mtime is the LRU order after a restart
+            os.utime(path)
+            return track
+        except OSError as e:
+            print("audio cache error:", e)
+            with self.lock:
+                self.size -= self.entries.pop(video_id, 0)
+            return None
+
+    def recorder(self, video_id, duration=None):
+        """A CacheRecorder for a track about to stream, or None if it's cached, already
+        being recorded by another session, or can't be."""
+        if not video_id or self.max_bytes <= 0:
+            return None
+        with self.lock:
+            if video_id in self.entries or video_id in self.recording:
+                return None
+            self.recording.add(video_id)
+        try:
+            return CacheRecorder(self, video_id, duration)
+        except OSError as e:
+            print("audio cache error:", e)
+            with self.lock:
+                self.recording.discard(video_id)
+            return None
+
+    def _commit(self, video_id, part_path, size):
+        with self.lock:
+            self.recording.discard(video_id)
+            try:
+                os.replace(part_path, self._file(video_id))
+            except OSError as e:
+                print("audio cache error:", e)
+                return
+            self.size += size - self.entries.pop(video_id, 0)
+            self.entries[video_id] = size
+            self._evict()
+
+    def _discard(self, video_id, part_path):
+        with self.lock:
+            self.recording.discard(video_id)
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "recording": len(self.recording),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
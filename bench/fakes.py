@@ -0,0 +1,493 @@
+"""Local stand-ins for everything the Music cog talks to: Discord (bot, guilds, text and
+voice channels, voice clients, button interactions), the extraction backend, the
+Spotify client and FFmpeg. The cog itself runs unchanged on top of them, see Harness.
+
+Import this before music_cog: it points the audio cache and the Spotify match index
+away from the bot's real files.
+"""
+import asyncio
+import hashlib
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+os.environ.setdefault("AUDIO_CACHE_BYTES", "0")
+os.environ.setdefault("MATCH_INDEX_PATH", ":memory:")
+os.environ.setdefault("FFMPEG_MIN_FREE_MB", "0")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import discord
+from discord.ui.view import ViewStore
+
+import music_cog
+import utilities
+from match_index import MatchIndex
+from player import FRAME_SECONDS
+from spotify_client import SpotifyError, parse_spotify_link
+
+ids = itertools.count(10 ** 17)
+
+# Any Opus frame will do, nothing decodes it
+OPUS_FRAME = b"\xf8\xff\xfe"
+
+
+def video_id_for(text):
+    """A stable, made up YouTube video id for a search or a playlist entry."""
+    return hashlib.sha1(text.encode()).hexdigest()[:11]
+
+
+class FakeFFmpegAudio:
+    """Takes the place of discord.FFmpegOpusAudio. The first read waits `startup` seconds
+    (FFmpeg connecting and probing the stream), then it yields the frames of the
+    duration encoded in the stream url as fast as they're read. With `child` it also
+    keeps an idle child process alive until cleanup(), like the real one keeps FFmpeg,
+    so leaked processes show up."""
+
+    def __init__(self, url, startup=0.0, child=False, **kwargs):
+        query = parse_qs(urlparse(url).query)
+        self.frames = int(float(query.get("dur", ["0"])[0]) / FRAME_SECONDS)
+        self.startup = startup
+        self.started = False
+        self.cleaned = False
+        self._process = subprocess.Popen(["sleep", "86400"]) if child else None
+
+    def read(self):
+        if not self.started:
+            self.started = True
+            time.sleep(self.startup)
+        if self.cleaned or self.frames <= 0:
+            return b""
+        self.frames -= 1
+        return OPUS_FRAME
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.cleaned = True
+        if self._process:
+            self._process.kill()
+            self._process.wait()
+
+
+class FakeExtractor:
+    """Extraction backend answering after `latency` seconds, without yt-dlp or network.
+
+    Urls with list= are playlists of `playlist_size` entries and a search is a video id
+    derived from the query, both flat like with YDL_OPTS' extract_flat (no stream url,
+    the track needs another extraction to play); any other url is a fully extracted
+    video of `track_seconds`."""
+
+    name = "fake"
+
+    def __init__(self, latency=0.05, playlist_size=100, track_seconds=30, workers=8):
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.track_seconds = track_seconds
+        self.workers = workers
+        self.calls = 0
+
+    async def start(self, loop):
+        pass
+
+    def close(self):
+        pass
+
+    def _video(self, video_id):
+        return {
+            "id": video_id,
+            "title": f"Faixa {video_id}",
+            "thumbnail": utilities.YOUTUBE_THUMB_URL.format(video_id),
+            "duration": self.track_seconds,
+            "webpage_url": utilities.YOUTUBE_WATCH_URL.format(video_id),
+            "audio_url": f"https://rr1.googlevideo.com/videoplayback?expire={int(time.time()) + 6 * 3600}&id={video_id}&dur={self.track_seconds}",
+            "acodec": "opus",
+            "asr": 48000,
+        }
+
+    def _flat(self, video_id, title):
+        # what extraction.slim_info makes of a flat entry
+        return {
+            "id": video_id,
+            "title": title,
+            "thumbnail": utilities.YOUTUBE_THUMB_URL.format(video_id),
+            "duration": self.track_seconds,
+            "url": utilities.YOUTUBE_WATCH_URL.format(video_id),
+        }
+
+    async def _extract(self, query, is_url):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if is_url and "list=" in query:
+            entries = [self._flat(video_id_for(f"{query}#{i}"), f"Faixa {i}") for i in range(self.playlist_size)]
+            return {"_type": "playlist", "title": "Playlist", "entries": entries}
+        if not is_url:
+            return self._flat(video_id_for(query), f"Faixa {query}")
+        return self._video(utilities.youtube_video_id(query) or video_id_for(query))
+
+    def extract(self, loop, query, is_url):
+        return asyncio.ensure_future(self._extract(query, is_url))
+
+
+class FakeSpotify:
+    """Spotify client whose playlists have `playlist_size` tracks, served in pages of 100
+    that each take `latency` seconds. Like AsyncSpotify, the next page is fetched
+    while the current one is consumed."""
+
+    def __init__(self, latency=0.1, playlist_size=100):
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.pages = 0
+
+    def _track(self, spotify_id, name):
+        return {
+            "type": "track",
+            "id": spotify_id,
+            "name": name,
+            "duration_ms": 30000,
+            "external_ids": {},
+            "artists": [{"name": "Artista"}],
+        }
+
+    async def _page(self):
+        self.pages += 1
+        await asyncio.sleep(self.latency)
+
+    async def tracks(self, link):
+        kind, spotify_id = parse_spotify_link(link)
+        if kind == "track":
+            await self._page()
+            yield self._track(spotify_id, f"Faixa {spotify_id}")
+            return
+        if kind not in ("playlist", "album"):
+            raise SpotifyError(f"not a Spotify track, album or playlist: {link}")
+        next_page = asyncio.ensure_future(self._page())
+        try:
+            for start in range(0, self.playlist_size, 100):
+                await next_page
+                next_page = asyncio.ensure_future(self._page()) if start + 100 < self.playlist_size else None
+                for i in range(start, min(start + 100, self.playlist_size)):
+                    yield self._track(f"{spotify_id[:14]}{i:08d}", f"Faixa {i} de {spotify_id}")
+        finally:
+            if next_page:
+                next_page.cancel()
+
+    async def close(self):
+        pass
+
+
+class Played:
+    """Timestamps (time.perf_counter) of one source the voice client played. It doesn't
+    keep the source, that would keep every FFmpeg ever played alive."""
+
+    __slots__ = ("first", "last", "frames")
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.frames = 0
+
+
+class FakeVoiceClient:
+    """Plays sources on a thread like discord.VoiceClient, reading a frame every
+    `frame_interval` seconds instead of every 20 ms, so tracks play faster than
+    real time. Every source played is recorded in `played`."""
+
+    def __init__(self, bot, guild, channel, frame_interval):
+        self.bot = bot
+        self.guild = guild
+        self.channel = channel
+        self.frame_interval = frame_interval
+        self.played = []
+        self._playing = False
+        self._paused = False
+        self._stop = None
+
+    def play(self, source, after=None):
+        if self._playing:
+            raise discord.ClientException("Already playing audio.")
+        self._playing = True
+        self._paused = False
+        self._stop = stop = threading.Event()
+        played = Played()
+        self.played.append(played)
+
+        def run():
+            while not stop.is_set():
+                if self._paused:
+                    time.sleep(0.001)
+                    continue
+                if not source.read():
+                    break
+                now = time.perf_counter()
+                if played.first is None:
+                    played.first = now
+                played.last = now
+                played.frames += 1
+                time.sleep(self.frame_interval)
+            if not stop.is_set():
+                self._playing = False
+                self._paused = False
+            source.cleanup()
+            if after:
+                after(None)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_playing(self):
+        return self._playing and not self._paused
+
+    def is_paused(self):
+        return self._playing and self._paused
+
+    def is_connected(self):
+        return True
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def stop(self):
+        # synchronous like discord.VoiceClient.stop(): the source is detached right away
+        if self._playing:
+            self._stop.set()
+            self._playing = False
+            self._paused = False
+
+    async def disconnect(self, force=False):
+        self.guild.api["voice_disconnect"] += 1
+        self.stop()
+        self.guild.voice_client = None
+        if self in self.bot.voice_clients:
+            self.bot.voice_clients.remove(self)
+
+
+class FakeVoiceChannel:
+    def __init__(self, bot, guild):
+        self.id = next(ids)
+        self.bot = bot
+        self.guild = guild
+
+    async def connect(self, **kwargs):
+        self.guild.api["voice_connect"] += 1
+        vc = FakeVoiceClient(self.bot, self.guild, self, self.bot.frame_interval)
+        self.guild.voice_client = vc
+        self.bot.voice_clients.append(vc)
+        return vc
+
+
+def store_view(state, view, message_id):
+    # what discord.py does with the view of a message it sent or edited
+    if view and not view.is_finished() and view.is_dispatchable():
+        state.store_view(view, message_id)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, view=None):
+        self.id = next(ids)
+        self._state = channel.guild.bot._connection
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.view = view
+        store_view(self._state, view, self.id)
+
+    async def edit(self, **kwargs):
+        self.channel.guild.api["message_edit"] += 1
+        self.embed = kwargs.get("embed", self.embed)
+        self.view = kwargs.get("view", self.view)
+        store_view(self._state, kwargs.get("view"), self.id)
+        return self
+
+    async def delete(self):
+        self.channel.guild.api["message_delete"] += 1
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeTextChannel:
+    def __init__(self, guild):
+        self.id = next(ids)
+        self.guild = guild
+        self.messages = {}
+
+    async def send(self, content=None, **kwargs):
+        self.guild.api["message_send"] += 1
+        message = FakeMessage(self, content, kwargs.get("embed"), kwargs.get("view"))
+        self.messages[message.id] = message
+        return message
+
+
+class FakeMember:
+    def __init__(self, voice_channel):
+        self.id = next(ids)
+        self.voice = type("VoiceState", (), {"channel": voice_channel})()
+
+
+class FakeGuild:
+    """A guild with one text channel, one voice channel and one member in it.
+    `api` counts the Discord API calls made on its behalf, by kind."""
+
+    def __init__(self, bot):
+        self.id = next(ids)
+        self.bot = bot
+        self.voice_client = None
+        self.api = Counter()
+        self.text_channel = FakeTextChannel(self)
+        self.voice_channel = FakeVoiceChannel(bot, self)
+        self.member = FakeMember(self.voice_channel)
+
+    def api_calls(self):
+        return sum(self.api.values())
+
+    def ctx(self):
+        return FakeContext(self)
+
+    def interaction(self):
+        return FakeInteraction(self)
+
+
+class FakeContext:
+    """What the cog uses of a commands.Context."""
+
+    def __init__(self, guild):
+        self.bot = guild.bot
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = guild.member
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+
+class FakeResponse:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def defer(self):
+        self.guild.api["interaction_defer"] += 1
+
+    async def edit_message(self, **kwargs):
+        self.guild.api["interaction_edit"] += 1
+
+
+class FakeInteraction:
+    """A button press in the guild's text channel, for the callbacks of CarrotButton."""
+
+    def __init__(self, guild):
+        self.client = guild.bot
+        self.guild = guild
+        self.user = guild.member
+        self.channel = guild.text_channel
+        self.response = FakeResponse(guild)
+
+
+class FakeState:
+    """The part of discord's ConnectionState messages use, around a real ViewStore, so
+    views left in it show up (see view_store_size)."""
+
+    def __init__(self):
+        self._view_store = ViewStore(self)
+
+    def store_view(self, view, message_id=None):
+        self._view_store.add_view(view, message_id)
+
+    def prevent_view_updates_for(self, message_id):
+        return self._view_store.remove_message_tracking(message_id)
+
+    def view_store_size(self):
+        """Message and view entries in the store."""
+        store = self._view_store
+        return len(store._views) + len(store._synced_message_views)
+
+
+class FakeBot:
+    def __init__(self, loop, frame_interval):
+        self.loop = loop
+        self.frame_interval = frame_interval
+        self.voice_clients = []
+        self.user = type("User", (), {"id": next(ids)})()
+        self.cogs = {}
+        self._connection = FakeState()
+
+    def add_view(self, view, message_id=None):
+        self._connection.store_view(view, message_id)
+
+    def add_dynamic_items(self, *items):
+        pass
+
+    def remove_dynamic_items(self, *items):
+        pass
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+
+class Harness:
+    """A real music_cog.Music on a FakeBot, with its extraction backend and Spotify
+    client swapped for FakeExtractor and FakeSpotify, and discord.FFmpegOpusAudio
+    for FakeFFmpegAudio (for the whole process). Every start() also begins with
+    empty stream and match caches so runs don't warm each other up."""
+
+    def __init__(self, extract_latency=0.05, spotify_latency=0.1, ffmpeg_startup=0.05,
+                 frame_interval=0.001, track_seconds=30, playlist_size=100, child_processes=False):
+        self.extractor = FakeExtractor(extract_latency, playlist_size, track_seconds, music_cog.EXTRACTION_WORKERS)
+        self.spotify = FakeSpotify(spotify_latency, playlist_size)
+        self.ffmpeg_startup = ffmpeg_startup
+        self.child_processes = child_processes
+        self.frame_interval = frame_interval
+        self.bot = None
+        self.cog = None
+        self.guilds = []
+
+    async def start(self):
+        music_cog.STREAM_CACHE = utilities.StreamCache(max_entries=music_cog.STREAM_CACHE.max_entries)
+        music_cog.MATCH_INDEX = MatchIndex(":memory:")
+        startup, child = self.ffmpeg_startup, self.child_processes
+        discord.FFmpegOpusAudio = lambda url, **kwargs: FakeFFmpegAudio(url, startup, child, **kwargs)
+
+        self.bot = FakeBot(asyncio.get_running_loop(), self.frame_interval)
+        self.cog = music_cog.Music(self.bot)
+        await self.cog.spotify.close()
+        self.cog.spotify = self.spotify
+        self.cog.extractor = self.cog.scheduler.backend = self.extractor
+        self.bot.cogs["Music"] = self.cog
+        await self.cog.cog_load()
+        return self
+
+    def guild(self):
+        guild = FakeGuild(self.bot)
+        self.guilds.append(guild)
+        return guild
+
+    def session(self, guild):
+        return self.cog.guild_session(guild)
+
+    async def settle(self, guild):
+        """Wait until the guild's background imports are done and its player message is up to date."""
+        session = self.session(guild)
+        if not session:
+            return
+        while session.tasks:
+            await asyncio.gather(*session.tasks, return_exceptions=True)
+        message = session.player_message
+        while message and message.task and not message.task.done():
+            await asyncio.gather(message.task, return_exceptions=True)
+
+    async def close(self):
+        for guild in self.guilds:
+            if guild.voice_client:
+                await self.cog.action_leave(guild.ctx(), False)
+        await self.cog.cog_unload()
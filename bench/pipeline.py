@@ -0,0 +1,247 @@
+"""Offline benchmark of the enqueue and playback pipeline: the real Music cog, on the
+stand-ins of bench/fakes.py (extraction, Spotify, FFmpeg and Discord), measuring
+
+  - time to first audio of ]play with a video url, a search and a Spotify playlist
+  - how fast YouTube and Spotify playlists get enqueued
+  - the gap between the last frame of a track and the first of the next one, when a
+    track ends by itself and on ]skip
+  - Discord API calls made per command and per button press
+
+    python bench/pipeline.py [-n 5] [--save-baseline] [--baseline FILE] [--tolerance 0.25]
+
+Results are compared with the baseline (bench/baseline.json by default) when it exists
+and was recorded with the same settings; the exit status is 1 if a metric got worse by
+more than the tolerance. --save-baseline records the results as the new baseline.
+Tracks play 1 / (0.02 / frame interval) times faster than real time, everything else
+(extraction, Spotify pages, FFmpeg startup, message edit intervals) takes real time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from fakes import Harness, video_id_for
+
+# Absolute slack of the millisecond metrics, below that a difference is noise
+SLACK_MS = 5.0
+
+
+async def wait_until(predicate, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        value = predicate()
+        if value:
+            return value
+        if time.perf_counter() > deadline:
+            raise TimeoutError("benchmark step timed out")
+        await asyncio.sleep(0.001)
+
+
+def first_frame(guild, index):
+    """When the voice client sent the first frame of its index-th source, or None."""
+    vc = guild.voice_client
+    if vc and len(vc.played) > index:
+        return vc.played[index].first
+    return None
+
+
+def ms(seconds):
+    return seconds * 1000
+
+
+def spotify_link(name):
+    return "https://open.spotify.com/playlist/" + (video_id_for(name) * 2)[:22]
+
+
+def youtube_link(name):
+    return "https://www.youtube.com/watch?v=" + video_id_for(name)
+
+
+def playlist_link(name):
+    return "https://www.youtube.com/playlist?list=PL" + video_id_for(name)
+
+
+async def first_audio(harness, query):
+    """Milliseconds from ]play in an idle guild to the first frame sent, and the guild."""
+    guild = harness.guild()
+    start = time.perf_counter()
+    await harness.cog.action_play(guild.ctx(), query, False)
+    first = await wait_until(lambda: first_frame(guild, 0))
+    return ms(first - start), start, guild
+
+
+async def bench_first_audio(harness, n, metrics):
+    url, search = [], []
+    for i in range(n):
+        url.append((await first_audio(harness, youtube_link(f"url {i}")))[0])
+        search.append((await first_audio(harness, f"artista musica {i}"))[0])
+    metrics["first_audio_url_ms"] = statistics.median(url)
+    metrics["first_audio_search_ms"] = statistics.median(search)
+
+
+async def bench_spotify(harness, n, metrics):
+    first, rates = [], []
+    for i in range(n):
+        elapsed, start, guild = await first_audio(harness, spotify_link(f"spotify {i}"))
+        first.append(elapsed)
+        await harness.settle(guild)
+        tracks = len(harness.session(guild).q)
+        rates.append(tracks / (time.perf_counter() - start))
+    metrics["first_audio_spotify_ms"] = statistics.median(first)
+    metrics["spotify_enqueue_tracks_per_s"] = statistics.median(rates)
+
+
+async def bench_youtube_playlist(harness, n, metrics):
+    rates = []
+    for i in range(n):
+        guild = harness.guild()
+        start = time.perf_counter()
+        await harness.cog.action_play(guild.ctx(), playlist_link(f"playlist {i}"), False)
+        rates.append(len(harness.session(guild).q) / (time.perf_counter() - start))
+    metrics["youtube_enqueue_tracks_per_s"] = statistics.median(rates)
+
+
+async def bench_transitions(harness, transitions, metrics):
+    guild = harness.guild()
+    await harness.cog.action_play(guild.ctx(), playlist_link("transitions"), False)
+    await wait_until(lambda: first_frame(guild, transitions), timeout=60.0)
+    played = guild.voice_client.played
+    gaps = [ms(played[k + 1].first - played[k].last) for k in range(transitions)]
+    metrics["transition_gap_ms"] = statistics.median(gaps)
+    metrics["transition_gap_max_ms"] = max(gaps)
+
+    # ]skip right as each track starts, so none of them ends by itself meanwhile
+    skips = []
+    for _ in range(transitions):
+        index = len(guild.voice_client.played)
+        start = time.perf_counter()
+        await harness.cog.action_skip(guild.ctx(), False)
+        skips.append(ms(await wait_until(lambda: first_frame(guild, index)) - start))
+    metrics["skip_to_audio_ms"] = statistics.median(skips)
+
+
+def button(harness, custom_id):
+    return next(item for item in harness.cog.player_views[False].children if item.custom_id == custom_id)
+
+
+async def api_calls(harness, guild, command, times=1):
+    """Discord API calls per run of `command`, everything it caused (background
+    imports, coalesced player message edits) included."""
+    before = guild.api_calls()
+    for _ in range(times):
+        await command()
+    await harness.settle(guild)
+    return (guild.api_calls() - before) / times
+
+
+async def bench_api_calls(harness, metrics):
+    cog = harness.cog
+    guild = harness.guild()
+    ctx = guild.ctx()
+    metrics["api_calls_play"] = await api_calls(harness, guild, lambda: cog.action_play(ctx, youtube_link("api"), False))
+    metrics["api_calls_play_playlist"] = await api_calls(harness, guild, lambda: cog.action_play(ctx, spotify_link("api"), False))
+    metrics["api_calls_skip"] = await api_calls(harness, guild, lambda: cog.action_skip(ctx, False))
+    metrics["api_calls_queue"] = await api_calls(harness, guild, lambda: cog.queue.callback(cog, ctx))
+    next_button = button(harness, "next_track")
+    metrics["api_calls_next_button"] = await api_calls(harness, guild, lambda: next_button.callback(guild.interaction()))
+    # presses in a row, the player message edits should coalesce
+    pause_button = button(harness, "pp_track")
+    metrics["api_calls_pause_button_burst"] = await api_calls(
+        harness, guild, lambda: pause_button.callback(guild.interaction()), times=10
+    )
+
+
+async def run(args):
+    harness = await Harness(
+        extract_latency=args.extract_latency,
+        spotify_latency=args.spotify_latency,
+        ffmpeg_startup=args.ffmpeg_startup,
+        frame_interval=args.frame_interval,
+        track_seconds=args.track_seconds,
+        playlist_size=args.playlist_size,
+    ).start()
+    metrics = {}
+    try:
+        await bench_first_audio(harness, args.n, metrics)
+        await bench_spotify(harness, args.n, metrics)
+        await bench_youtube_playlist(harness, args.n, metrics)
+        await bench_transitions(harness, args.transitions, metrics)
+        await bench_api_calls(harness, metrics)
+    finally:
+        await harness.close()
+    return metrics
+
+
+def regressed(name, value, base, tolerance):
+    if name.endswith("_max_ms"):
+        # a single worst sample, scheduler jitter alone moves it by several times
+        return False
+    if name.endswith("_per_s"):
+        return value < base * (1 - tolerance)
+    slack = SLACK_MS if name.endswith("_ms") else 0.0
+    return value > base * (1 + tolerance) + slack
+
+
+def report(metrics, baseline, tolerance):
+    """Print the results next to the baseline, return the names of the metrics that regressed."""
+    worse = []
+    for name, value in metrics.items():
+        line = f"{name:>32}: {value:10.2f}"
+        base = baseline.get(name) if baseline else None
+        if base is not None:
+            change = (value - base) / base if base else 0.0
+            line += f"   baseline {base:10.2f}   {change:+7.1%}"
+            if regressed(name, value, base, tolerance):
+                line += "   REGRESSION"
+                worse.append(name)
+        print(line)
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=5, help="runs of each first-audio and enqueue measurement")
+    parser.add_argument("--transitions", type=int, default=5, help="track transitions (and skips) measured")
+    parser.add_argument("--extract-latency", type=float, default=0.05, help="seconds per extraction")
+    parser.add_argument("--spotify-latency", type=float, default=0.1, help="seconds per Spotify page")
+    parser.add_argument("--ffmpeg-startup", type=float, default=0.05, help="seconds before FFmpeg's first frame")
+    parser.add_argument("--frame-interval", type=float, default=0.001, help="seconds between frames sent")
+    parser.add_argument("--track-seconds", type=int, default=15, help="duration of every track")
+    parser.add_argument("--playlist-size", type=int, default=200, help="tracks per playlist")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(__file__), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="record the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change allowed before it's a regression")
+    args = parser.parse_args()
+
+    settings = {
+        key: getattr(args, key)
+        for key in ("n", "transitions", "extract_latency", "spotify_latency", "ffmpeg_startup",
+                    "frame_interval", "track_seconds", "playlist_size")
+    }
+    metrics = asyncio.run(run(args))
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved.get("settings") == settings:
+            baseline = saved["metrics"]
+        else:
+            print(f"{args.baseline} was recorded with other settings, not comparing\n")
+
+    worse = report(metrics, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "metrics": metrics}, f, indent=2)
+            f.write("\n")
+        print(f"\nbaseline saved to {args.baseline}")
+    elif worse:
+        print(f"\n{len(worse)} metric(s) regressed by more than {args.tolerance:.0%}: {', '.join(worse)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Memory held by a utilities.Queue of N tracks, per track, against the list of
+namedtuples the queue used to be.
+
+    python bench/queue_memory.py [-n 10000]
+
+Tracks look like the ones a YouTube playlist import queues (id, title, thumbnail,
+link, duration) and are built inside the measured region, so their strings count.
+Also prints what Queue.memory_usage() (shown by ]diag) estimates.
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from utilities import Queue, YOUTUBE_WATCH_URL
+
+
+def tracks(n):
+    for i in range(n):
+        video_id = f"v{i:010d}"
+        yield (f"Some Artist - Some Song Title #{i} (Official Audio)", video_id,
+               f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg?sqp=-oaymwE&rs=AOn4CLB", YOUTUBE_WATCH_URL.format(video_id), 200 + i % 300)
+
+
+def measure(build, n):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    held = build(tracks(n))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return held, sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+def build_queue(source):
+    q = Queue()
+    q.enqueue_many(source)
+    return q
+
+
+def build_namedtuples(source):
+    music = namedtuple("music", ("title", "video_id", "thumb", "link", "duration"))
+    return [music(*track) for track in source]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=10000, help="tracks to queue")
+    args = parser.parse_args()
+
+    print(f"{args.n} tracks")
+    old, old_size = measure(build_namedtuples, args.n)
+    print(f"  namedtuple list: {old_size / 1024:8.0f} KB   {old_size / args.n:6.0f} B/track")
+    del old
+    q, size = measure(build_queue, args.n)
+    print(f"  Queue:           {size / 1024:8.0f} KB   {size / args.n:6.0f} B/track")
+    print(f"  memory_usage():  {q.memory_usage() / 1024:8.0f} KB   {q.memory_usage() / args.n:6.0f} B/track")
+
+
+if __name__ == "__main__":
+    main()
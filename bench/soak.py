@@ -0,0 +1,308 @@
+"""Load and soak test: N simulated guilds run scripted command mixes (]play, playlist
+imports, skip spam, button presses, ]queue, leaving) against the real Music cog on
+the stand-ins of bench/fakes.py, for as long as asked.
+
+    python bench/soak.py [--guilds 50] [--duration 600] [--csv soak.csv] [--chart soak.png]
+
+Every --interval seconds it samples p50/p99 command latency, the worst event loop lag,
+RSS, open file descriptors, threads (but the event loop's executor pool), child
+processes (with --child-processes every fake FFmpeg is a real idle child, so leaked
+ones show up), FFmpeg processes the governor tracks, sessions and entries in discord's
+view store (which grows if views stay filed under messages), prints them and
+appends them to the CSV. --chart plots them at the
+end (needs matplotlib). After the run every guild leaves and the leftovers are reported:
+anything above what was there before the run is a leak.
+"""
+import argparse
+import asyncio
+import csv
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from fakes import Harness
+from pipeline import button, playlist_link, spotify_link, youtube_link
+
+from ffmpeg_governor import process_rss_bytes
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# command -> weight of the scripted mix
+MIX = {
+    "play": 30,
+    "search": 15,
+    "playlist": 5,
+    "spotify_playlist": 5,
+    "skip_spam": 10,
+    "button": 20,
+    "queue": 10,
+    "leave": 5,
+}
+BUTTONS = ("pp_track", "next_track", "prev_track")
+SKIP_SPAM = 5
+LAG_PROBE = 0.05
+
+COLUMNS = (
+    "elapsed_s", "commands", "errors", "p50_ms", "p99_ms", "loop_lag_max_ms", "rss_mb",
+    "open_fds", "threads", "child_processes", "ffmpeg_running", "sessions", "view_store",
+    "extraction_waiting",
+)
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def open_fds():
+    try:
+        if psutil:
+            return psutil.Process().num_fds()
+        return len(os.listdir("/proc/self/fd"))
+    except Exception:
+        return -1
+
+
+def threads():
+    # the event loop's default executor keeps its threads around, they're not leaks
+    return sum(1 for thread in threading.enumerate() if not thread.name.startswith("asyncio_"))
+
+
+def child_processes():
+    try:
+        if psutil:
+            return len(psutil.Process().children(recursive=True))
+        pid = str(os.getpid())
+        count = 0
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open(f"/proc/{name}/stat") as f:
+                        if f.read().rsplit(")", 1)[1].split()[1] == pid:
+                            count += 1
+                except OSError:
+                    pass
+        return count
+    except Exception:
+        return -1
+
+
+class Recorder:
+    """Command latencies and loop lag of the current sampling window, and of the whole run per command."""
+
+    def __init__(self):
+        self.window = []
+        self.lag = 0.0
+        self.commands = 0
+        self.errors = 0
+        self.by_command = defaultdict(list)
+
+    def record(self, command, seconds):
+        self.window.append(seconds)
+        self.by_command[command].append(seconds)
+        self.commands += 1
+
+    def take_window(self):
+        window, lag = self.window, self.lag
+        self.window, self.lag = [], 0.0
+        return window, lag
+
+
+async def probe_loop_lag(recorder):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_PROBE)
+        recorder.lag = max(recorder.lag, time.perf_counter() - start - LAG_PROBE)
+
+
+async def timed(recorder, command, coro):
+    start = time.perf_counter()
+    try:
+        await coro
+    except Exception as e:
+        recorder.errors += 1
+        if recorder.errors <= 10:
+            print(f"{command} error:", repr(e))
+        return
+    recorder.record(command, time.perf_counter() - start)
+
+
+async def run_guild(harness, guild, recorder, rng, deadline, think):
+    """One guild's users: a random command from MIX, a pause, and again until the deadline."""
+    cog = harness.cog
+    commands, weights = zip(*MIX.items())
+    n = 0
+    while time.perf_counter() < deadline:
+        n += 1
+        ctx = guild.ctx()
+        command = rng.choices(commands, weights)[0]
+        if not guild.voice_client and command not in ("play", "search", "playlist", "spotify_playlist"):
+            command = "play"
+        if command == "play":
+            await timed(recorder, command, cog.action_play(ctx, youtube_link(f"{guild.id} {n}"), False))
+        elif command == "search":
+            await timed(recorder, command, cog.action_play(ctx, f"artista musica {rng.randrange(10000)}", False))
+        elif command == "playlist":
+            await timed(recorder, command, cog.action_play(ctx, playlist_link(f"{guild.id} {n}"), False))
+        elif command == "spotify_playlist":
+            await timed(recorder, command, cog.action_play(ctx, spotify_link(f"{guild.id} {n}"), False))
+        elif command == "skip_spam":
+            for _ in range(SKIP_SPAM):
+                await timed(recorder, "skip", cog.action_skip(ctx, False))
+        elif command == "button":
+            custom_id = rng.choice(BUTTONS)
+            await timed(recorder, custom_id, button(harness, custom_id).callback(guild.interaction()))
+        elif command == "queue":
+            await timed(recorder, command, cog.queue.callback(cog, ctx))
+        elif command == "leave":
+            await timed(recorder, command, cog.action_leave(ctx, False))
+        await asyncio.sleep(rng.expovariate(1 / think))
+
+
+def sample(harness, recorder, started):
+    window, lag = recorder.take_window()
+    return {
+        "elapsed_s": round(time.perf_counter() - started, 1),
+        "commands": recorder.commands,
+        "errors": recorder.errors,
+        "p50_ms": round(percentile(window, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(window, 0.99) * 1000, 2),
+        "loop_lag_max_ms": round(lag * 1000, 2),
+        "rss_mb": round((process_rss_bytes(os.getpid()) or 0) / 1024 ** 2, 1),
+        "open_fds": open_fds(),
+        "threads": threads(),
+        "child_processes": child_processes(),
+        "ffmpeg_running": harness.cog.ffmpeg.stats()["running"],
+        "sessions": len(harness.cog.sessions),
+        "view_store": harness.bot._connection.view_store_size(),
+        "extraction_waiting": harness.cog.scheduler.stats()["waiting"],
+    }
+
+
+async def run(args):
+    harness = await Harness(
+        extract_latency=args.extract_latency,
+        spotify_latency=args.spotify_latency,
+        ffmpeg_startup=args.ffmpeg_startup,
+        frame_interval=args.frame_interval,
+        track_seconds=args.track_seconds,
+        playlist_size=args.playlist_size,
+        child_processes=args.child_processes,
+    ).start()
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    samples = []
+    writer = None
+    csv_file = open(args.csv, "w", newline="") if args.csv else None
+    if csv_file:
+        writer = csv.DictWriter(csv_file, COLUMNS)
+        writer.writeheader()
+
+    before = sample(harness, recorder, time.perf_counter())
+    started = time.perf_counter()
+    deadline = started + args.duration
+    probe = asyncio.ensure_future(probe_loop_lag(recorder))
+    guilds = [
+        asyncio.ensure_future(run_guild(harness, harness.guild(), recorder, random.Random(rng.random()), deadline, args.think))
+        for _ in range(args.guilds)
+    ]
+    print(" ".join(f"{column:>10}" for column in COLUMNS))
+    try:
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(min(args.interval, max(0.0, deadline - time.perf_counter())))
+            row = sample(harness, recorder, started)
+            samples.append(row)
+            print(" ".join(f"{row[column]:>10}" for column in COLUMNS))
+            if writer:
+                writer.writerow(row)
+                csv_file.flush()
+        await asyncio.gather(*guilds)
+    finally:
+        for task in guilds:
+            task.cancel()
+        await harness.close()
+        probe.cancel()
+        if csv_file:
+            csv_file.close()
+
+    # let the audio threads notice they were stopped and clean up
+    await asyncio.sleep(2)
+    after = sample(harness, recorder, started)
+    return samples, before, after, recorder
+
+
+def summary(before, after, recorder):
+    print("\ncommand latency over the run:")
+    for command, samples in sorted(recorder.by_command.items()):
+        print(
+            f"{command:>18}: {len(samples):7d} runs   p50 {percentile(samples, 0.5) * 1000:8.1f} ms"
+            f"   p99 {percentile(samples, 0.99) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms"
+        )
+    print(f"\n{recorder.commands} commands, {recorder.errors} errors")
+    print("after every guild left (before the run):")
+    for column in ("threads", "open_fds", "child_processes", "ffmpeg_running", "sessions", "view_store"):
+        leaked = after[column] > before[column]
+        print(f"{column:>18}: {after[column]} ({before[column]}){'   LEAK' if leaked else ''}")
+
+
+def chart(samples, path):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("--chart needs matplotlib (pip install matplotlib)")
+        return
+    elapsed = [row["elapsed_s"] for row in samples]
+    panels = (
+        ("command latency (ms)", ("p50_ms", "p99_ms")),
+        ("event loop lag (ms)", ("loop_lag_max_ms",)),
+        ("RSS (MB)", ("rss_mb",)),
+        ("resources", ("open_fds", "threads", "child_processes", "ffmpeg_running", "sessions", "view_store")),
+    )
+    fig, axes = plt.subplots(len(panels), 1, sharex=True, figsize=(10, 3 * len(panels)))
+    for ax, (title, columns) in zip(axes, panels):
+        for column in columns:
+            ax.plot(elapsed, [row[column] for row in samples], label=column)
+        ax.set_title(title)
+        ax.legend(loc="upper left")
+        ax.grid(True, alpha=0.3)
+    axes[-1].set_xlabel("seconds")
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"chart saved to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=50, help="simulated guilds")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between samples")
+    parser.add_argument("--think", type=float, default=2.0, help="mean seconds between a guild's commands")
+    parser.add_argument("--extract-latency", type=float, default=0.3, help="seconds per extraction")
+    parser.add_argument("--spotify-latency", type=float, default=0.2, help="seconds per Spotify page")
+    parser.add_argument("--ffmpeg-startup", type=float, default=0.1, help="seconds before FFmpeg's first frame")
+    parser.add_argument("--frame-interval", type=float, default=0.005, help="seconds between frames sent")
+    parser.add_argument("--track-seconds", type=int, default=60, help="duration of every track")
+    parser.add_argument("--playlist-size", type=int, default=100, help="tracks per playlist")
+    parser.add_argument("--child-processes", action="store_true", help="start an idle child process per fake FFmpeg")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--csv", help="write the samples to this CSV file")
+    parser.add_argument("--chart", help="plot the samples to this image (needs matplotlib)")
+    args = parser.parse_args()
+
+    samples, before, after, recorder = asyncio.run(run(args))
+    summary(before, after, recorder)
+    if args.chart and samples:
+        chart(samples, args.chart)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Per-extraction overhead of a fresh YoutubeDL per call (the old _extract_info_sync)
+against an instance checked out of a warmed extraction.YDLPool.
+
+    python bench/ydl_pool.py [-n 20] [--url URL]
+
+Without --url only the setup cost around an extraction is measured, so it runs offline.
+With --url every iteration also extracts that video, like fetch_video_info does.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yt_dlp
+
+from extraction import YDLPool, WARM_EXTRACTORS
+
+OPTS = {
+    "format": "ba[acodec=opus][abr<=128]/ba[acodec=opus]/bestaudio/best",
+    "quiet": True,
+    "extract_flat": "in_playlist",
+}
+
+
+def run_fresh(url):
+    with yt_dlp.YoutubeDL(OPTS) as ydl:
+        for ie_key in WARM_EXTRACTORS:
+            ydl.get_info_extractor(ie_key)
+        if url:
+            ydl.extract_info(url, download=False)
+
+
+def run_pooled(pool, url):
+    with pool.acquire() as ydl:
+        if url:
+            ydl.extract_info(url, download=False)
+
+
+def measure(fn, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:>8}: mean {statistics.mean(samples):8.2f} ms   median {statistics.median(samples):8.2f} ms   max {max(samples):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=20, help="extractions per variant")
+    parser.add_argument("--url", help="video to extract on every iteration (needs network)")
+    args = parser.parse_args()
+
+    # first instance pays for importing the extractor classes, keep it out of both runs
+    run_fresh(None)
+    pool = YDLPool(OPTS, 1)
+
+    report("fresh", measure(lambda: run_fresh(args.url), args.n))
+    report("pooled", measure(lambda: run_pooled(pool, args.url), args.n))
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+import asyncio
+import multiprocessing
+import queue
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import yt_dlp
+
+from utilities import youtube_video_id
+
+# Extractors used by the bot, instantiated up front so their caches (player JS,
+# signature functions) are shared by every extraction made with the instance
+WARM_EXTRACTORS = ("Youtube", "YoutubeTab", "YoutubeSearch")
+
+
+class ExtractionError(Exception):
+    """yt-dlp failure, reduced to its message so it can cross process boundaries."""
+
+
+def create_ydl(opts):
+    ydl = yt_dlp.YoutubeDL(opts)
+    for ie_key in WARM_EXTRACTORS:
+        ydl.get_info_extractor(ie_key)
+    return ydl
+
+
+def best_audio_format(info):
+    """ Given a fully-extracted yt-dlp video info dict, return the format of its best audio-only stream, or None. """
+    formats = info.get("formats", []) or []
+    audio_formats = [
+        f for f in formats
+        if f.get("acodec")
+        and f.get("acodec") != "none"
+        and (not f.get("vcodec") or f.get("vcodec") == "none")
+        and f.get("url")
+    ]
+    if not audio_formats:
+        return None
+
+    # Prefer highest abr (already capped by YDL_OPTS)
+    return max(audio_formats, key=lambda f: f.get("abr") or 0)
+
+
+def slim_info(info):
+    """ Keep only the part of a yt-dlp info dict the bot uses. A full info dict is
+    hundreds of KB (every format, subtitles, heatmaps...), this is a few hundred bytes. """
+    if info.get("_type") == "playlist":
+        return {
+            "_type": "playlist",
+            "title": info.get("title"),
+            "entries": [slim_info(entry) for entry in info.get("entries") or [] if entry],
+        }
+    thumb = info.get("thumbnail")
+    if not thumb and info.get("thumbnails"):
+        thumb = info["thumbnails"][0].get("url")
+    audio = best_audio_format(info) or {}
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "thumbnail": thumb,
+        "duration": info.get("duration"),
+        "url": info.get("url") if info.get("_type") == "url" else None,
+        "webpage_url": info.get("webpage_url"),
+        "original_url": info.get("original_url"),
+        "audio_url": audio.get("url"),
+        # codec and sample rate of the stream, to tell whether it can be played without re-encoding
+        "acodec": audio.get("acodec"),
+        "asr": audio.get("asr"),
+    }
+
+
+def extract(ydl, query, is_url):
+    if is_url:
+        info = ydl.extract_info(query, download=False)
+    else:
+        info = ydl.extract_info(f"ytsearch:{query}", download=False)['entries'][0]
+    return slim_info(info)
+
+
+class YDLPool:
+    """Pool of warmed, reusable YoutubeDL instances.
+
+    A YoutubeDL is not thread-safe, so an instance is checked out by a single
+    worker thread for the whole extraction and only returned afterwards. The
+    pool grows if more threads than `size` ask for one at the same time."""
+
+    def __init__(self, opts, size):
+        self.opts = opts
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        for _ in range(size):
+            self.idle.put(self._create())
+
+    def _create(self):
+        self.created += 1
+        return create_ydl(self.opts)
+
+    @contextmanager
+    def acquire(self):
+        try:
+            ydl = self.idle.get_nowait()
+        except queue.Empty:
+            ydl = self._create()
+        try:
+            yield ydl
+        finally:
+            self.idle.put(ydl)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ThreadBackend:
+    """Extractions on a thread pool, each thread using a YoutubeDL from a YDLPool.
+    Cheap to start, but yt-dlp's parsing holds the GIL so it doesn't scale past one core."""
+
+    name = "thread"
+
+    def __init__(self, opts, workers):
+        self.opts = opts
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="yt-dlp")
+        self.pool = None
+
+    async def start(self, loop):
+        # Building (and warming) the YoutubeDL instances is slow, keep it off the event loop
+        self.pool = await loop.run_in_executor(self.executor, YDLPool, self.opts, self.workers)
+
+    def _extract_sync(self, query, is_url):
+        with self.pool.acquire() as ydl:
+            return extract(ydl, query, is_url)
+
+    def extract(self, loop, query, is_url):
+        return loop.run_in_executor(self.executor, self._extract_sync, query, is_url)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.pool:
+            self.pool.close()
+
+
+# YoutubeDL owned by a ProcessBackend worker, one per process
+_worker_ydl = None
+
+
+def _init_worker(opts):
+    global _worker_ydl
+    _worker_ydl = create_ydl(opts)
+
+
+def _ping():
+    return True
+
+
+def _process_extract(query, is_url):
+    try:
+        return extract(_worker_ydl, query, is_url)
+    except Exception as e:
+        raise ExtractionError(str(e)) from None
+
+
+class ProcessBackend:
+    """Extractions on a pool of worker processes, each with its own warmed YoutubeDL.
+    Only the slim info dict travels back, and throughput scales with the number of cores."""
+
+    name = "process"
+
+    def __init__(self, opts, workers):
+        self.workers = workers
+        # spawn, not fork: the bot process already runs threads (audio players, executors)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(opts,),
+        )
+
+    async def start(self, loop):
+        # Processes are spawned lazily, make every worker boot (and warm up) now
+        await asyncio.gather(*(loop.run_in_executor(self.executor, _ping) for _ in range(self.workers)))
+
+    def extract(self, loop, query, is_url):
+        return loop.run_in_executor(self.executor, _process_extract, query, is_url)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+BACKENDS = {backend.name: backend for backend in (ThreadBackend, ProcessBackend)}
+
+
+def create_backend(name, opts, workers):
+    try:
+        return BACKENDS[name](opts, workers)
+    except KeyError:
+        raise ValueError(f"unknown extraction backend {name!r}, expected one of {', '.join(BACKENDS)}") from None
+
+
+# Scheduler priorities, lower goes first
+PRIORITY_INTERACTIVE = 0  # a user is waiting on it (]play, track about to start)
+PRIORITY_PREFETCH = 1     # next tracks of a queue that is playing
+PRIORITY_BULK = 2         # rest of a playlist import
+
+
+class ExtractionRejected(Exception):
+    """The guild already has too many extractions waiting."""
+
+
+class QueuedExtraction:
+    """An extraction waiting for a slot, kept by key so a caller joining it can promote it."""
+
+    __slots__ = ("future", "guild_id", "priority")
+
+    def __init__(self, future, guild_id, priority):
+        self.future = future
+        self.guild_id = guild_id
+        self.priority = priority
+
+
+class GuildExtractionStats:
+    __slots__ = ("waiting", "running", "done", "total_wait", "max_wait")
+
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.done = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "done": self.done,
+            "avg_wait": self.total_wait / self.done if self.done else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class ExtractionScheduler:
+    """Fair admission control in front of an extraction backend.
+
+    At most `max_running` extractions run at once. Everything else waits in a
+    per-guild queue; when a slot frees up the highest priority with waiters wins
+    and, within it, guilds are served round-robin. So a guild importing a huge
+    playlist gets one slot in turn like everybody else, and never delays another
+    guild's ]play or next track. A guild with more than `max_waiting` pending
+    extractions gets ExtractionRejected. An extraction started with a key can be
+    moved up to a higher priority while it waits, see promote()."""
+
+    def __init__(self, backend, max_running, max_waiting=256):
+        self.backend = backend
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.running = 0
+        # priority -> {guild_id: deque of waiter futures}, dict order is the round-robin order
+        self.waiters = {priority: {} for priority in (PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, PRIORITY_BULK)}
+        self.guilds = {}
+        # key -> QueuedExtraction of the extractions waiting that were given a key
+        self.queued = {}
+        self.promoted = 0
+
+    def _stats(self, guild_id):
+        stats = self.guilds.get(guild_id)
+        if stats is None:
+            stats = self.guilds[guild_id] = GuildExtractionStats()
+        return stats
+
+    def _has_waiters(self):
+        return any(self.waiters.values())
+
+    def _dispatch(self):
+        while self.running < self.max_running:
+            for guild_queues in self.waiters.values():
+                if guild_queues:
+                    break
+            else:
+                return
+            guild_id = next(iter(guild_queues))
+            waiting = guild_queues.pop(guild_id)
+            future = waiting.popleft()
+            if waiting:
+                # back of the line for this guild
+                guild_queues[guild_id] = waiting
+            self._stats(guild_id).waiting -= 1
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    async def _acquire(self, loop, guild_id, priority, key=None):
+        stats = self._stats(guild_id)
+        if self.running < self.max_running and not self._has_waiters():
+            self.running += 1
+            return
+        if stats.waiting >= self.max_waiting:
+            raise ExtractionRejected(f"guild {guild_id} has {stats.waiting} extractions waiting")
+
+        future = loop.create_future()
+        self.waiters[priority].setdefault(guild_id, deque()).append(future)
+        stats.waiting += 1
+        queued = None
+        if key is not None:
+            queued = self.queued[key] = QueuedExtraction(future, guild_id, priority)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over right before the cancellation, give it back
+                self._release()
+            raise
+        finally:
+            if queued and self.queued.get(key) is queued:
+                del self.queued[key]
+
+    def promote(self, key, priority):
+        """Move the extraction of `key` still waiting for a slot to the back of its guild's
+        queue at `priority`, if that's higher than its own. Returns whether it moved."""
+        queued = self.queued.get(key)
+        if queued is None or queued.future.done() or queued.priority <= priority:
+            return False
+        guild_queues = self.waiters[queued.priority]
+        waiting = guild_queues[queued.guild_id]
+        waiting.remove(queued.future)
+        if not waiting:
+            del guild_queues[queued.guild_id]
+        self.waiters[priority].setdefault(queued.guild_id, deque()).append(queued.future)
+        queued.priority = priority
+        self.promoted += 1
+        return True
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    async def extract(self, loop, query, is_url, guild_id=None, priority=PRIORITY_INTERACTIVE, key=None):
+        stats = self._stats(guild_id)
+        queued_at = time.monotonic()
+        await self._acquire(loop, guild_id, priority, key)
+        wait = time.monotonic() - queued_at
+        stats.done += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        stats.running += 1
+        try:
+            return await self.backend.extract(loop, query, is_url)
+        finally:
+            stats.running -= 1
+            self._release()
+
+    def stats(self, guild_id=None):
+        if guild_id is not None:
+            return self._stats(guild_id).as_dict()
+        return {
+            "running": self.running,
+            "waiting": sum(s.waiting for s in self.guilds.values()),
+            "promoted": self.promoted,
+            "guilds": {guild_id: s.as_dict() for guild_id, s in self.guilds.items() if s.waiting or s.running},
+        }
+
+
+def extraction_key(query, is_url):
+    """Normalize a request so that the same video or search asked in different ways shares one key."""
+    if is_url:
+        video_id = youtube_video_id(query)
+        return "video:" + video_id if video_id else "url:" + query.strip()
+    return "search:" + " ".join(query.casefold().split())
+
+
+class SingleFlight:
+    """Merges identical extractions that are in flight at the same time.
+
+    The first caller for a key starts the work, everybody asking for the same key
+    until it finishes awaits that same result (or exception). A waiter being
+    cancelled doesn't cancel the shared extraction."""
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.merged = 0
+
+    async def do(self, key, fn):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None) if self.calls.get(key) is f else None)
+            self.started += 1
+        else:
+            self.merged += 1
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {"in_flight": len(self.calls), "started": self.started, "merged": self.merged}
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def process_cpu_seconds(pid):
+    """CPU time (user + system) a process has used so far, or None if it can't be measured.
+    Uses psutil when installed, else /proc (Linux)."""
+    try:
+        if psutil:
+            times = psutil.Process(pid).cpu_times()
+            return times.user + times.system
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+
+def process_rss_bytes(pid):
+    """Resident memory of a process, or None if it can't be measured."""
+    try:
+        if psutil:
+            return psutil.Process(pid).memory_info().rss
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
+
+def available_memory_bytes():
+    """Memory the host can still hand out, or None if it can't be measured."""
+    try:
+        if psutil:
+            return psutil.virtual_memory().available
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    return None
+
+
+class EncodingStats:
+    """CPU used by the FFmpeg processes per second of audio they produced, by encoding mode
+    ("copy" or the name of an encoding profile). Recorded when a process is closed."""
+
+    def __init__(self):
+        # mode -> [streams, cpu seconds, audio seconds]
+        self.modes = {}
+
+    def record(self, mode, cpu_seconds, audio_seconds):
+        totals = self.modes.setdefault(mode, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += cpu_seconds
+        totals[2] += audio_seconds
+
+    def report(self):
+        """mode -> (streams, share of one core a stream of that mode keeps busy)."""
+        return {
+            mode: (streams, cpu / audio if audio else 0.0)
+            for mode, (streams, cpu, audio) in self.modes.items()
+        }
+
+
+ENCODING_STATS = EncodingStats()
+
+
+# Seconds a process may run without a source owning it (it's being wrapped, or it leaked)
+ORPHAN_GRACE = 60
+
+
+class FFmpegSaturated(Exception):
+    """No FFmpeg process can be started right now (too many running, or the host is low on memory)."""
+
+
+class FFmpegProcess:
+    """One FFmpeg process started through the governor, and its accounting.
+
+    close() measures it, kills it and gives its slot back. It's called from the audio
+    thread when the source is cleaned up, or by the governor's reaper for orphans."""
+
+    def __init__(self, governor, guild_id, mode, audio):
+        self.governor = governor
+        self.guild_id = guild_id
+        self.mode = mode
+        # the discord.FFmpegOpusAudio
+        self.audio = audio
+        process = getattr(audio, "_process", None)
+        self.pid = process.pid if process else None
+        self.started_at = time.monotonic()
+        self.peak_rss = 0
+        self.closed = False
+        # the TrackSource playing it, see attach()
+        self.owner = None
+
+    def attach(self, owner):
+        self.owner = weakref.ref(owner)
+
+    def age(self):
+        return time.monotonic() - self.started_at
+
+    def sample(self):
+        rss = process_rss_bytes(self.pid) if self.pid else None
+        if rss:
+            self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def close(self, audio_seconds=0.0):
+        with self.governor.lock:
+            if self.closed:
+                return
+            self.closed = True
+        cpu = process_cpu_seconds(self.pid) if self.pid else None
+        self.sample()
+        if cpu is not None and audio_seconds:
+            ENCODING_STATS.record(self.mode, cpu, audio_seconds)
+        try:
+            self.audio.cleanup()
+        finally:
+            self.governor._released(self, cpu)
+
+
+class FFmpegGovernor:
+    """Every FFmpeg process of the bot is started through spawn().
+
+    At most `max_processes` run at once. Past that, spawn() waits up to `queue_timeout`
+    seconds for a slot, then raises FFmpegSaturated; it also raises right away when the
+    host has less than `min_free_memory` bytes available, so a spike of playback is
+    turned away instead of getting the box OOM-killed. reap() closes orphans: processes
+    no source took ownership of, or whose source is gone without having cleaned them
+    up, and processes older than `max_lifetime`."""
+
+    def __init__(self, max_processes, queue_timeout=15.0, min_free_memory=0, max_lifetime=None):
+        self.max_processes = max_processes
+        self.queue_timeout = queue_timeout
+        self.min_free_memory = min_free_memory
+        self.max_lifetime = max_lifetime
+        self.slots = asyncio.Semaphore(max_processes)
+        self.loop = None
+        self.lock = threading.Lock()
+        # id(process) -> FFmpegProcess, the ones running
+        self.processes = {}
+        self.waiting = 0
+        self.started = 0
+        self.rejected = 0
+        self.reaped = 0
+        self.total_lifetime = 0.0
+        self.total_cpu = 0.0
+
+    def _host_saturated(self):
+        if not self.min_free_memory:
+            return False
+        available = available_memory_bytes()
+        return available is not None and available < self.min_free_memory
+
+    async def _acquire(self, wait):
+        if self._host_saturated():
+            raise FFmpegSaturated("host is low on memory")
+        if self.slots.locked():
+            if not wait:
+                raise FFmpegSaturated(f"{self.max_processes} FFmpeg processes running")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise FFmpegSaturated(f"no FFmpeg slot freed up in {self.queue_timeout:.0f}s") from None
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+
+    async def spawn(self, guild_id, mode, create, wait=True):
+        """Start an FFmpeg process with create() once a slot is free and return its FFmpegProcess.
+        With wait=False, raise FFmpegSaturated instead of waiting for a slot."""
+        self.loop = asyncio.get_running_loop()
+        try:
+            await self._acquire(wait)
+        except FFmpegSaturated:
+            self.rejected += 1
+            raise
+        try:
+            audio = create()
+        except BaseException:
+            self.slots.release()
+            raise
+        process = FFmpegProcess(self, guild_id, mode, audio)
+        with self.lock:
+            self.processes[id(process)] = process
+        self.started += 1
+        return process
+
+    def _released(self, process, cpu):
+        with self.lock:
+            self.processes.pop(id(process), None)
+            self.total_lifetime += process.age()
+            self.total_cpu += cpu or 0.0
+        # the audio thread closes most processes, the semaphore belongs to the event loop
+        try:
+            self.loop.call_soon_threadsafe(self.slots.release)
+        except RuntimeError:
+            # the loop is closed, the bot is shutting down
+            pass
+
+    def reap(self):
+        """Close orphaned and expired processes, sample the memory of the others."""
+        with self.lock:
+            processes = list(self.processes.values())
+        for process in processes:
+            if process.owner is None:
+                orphan = process.age() > ORPHAN_GRACE
+            else:
+                orphan = process.owner() is None
+            expired = self.max_lifetime and process.age() > self.max_lifetime
+            if orphan or expired:
+                print(f"reaping FFmpeg {process.pid} of guild {process.guild_id}:", "orphan" if orphan else "expired")
+                process.close()
+                self.reaped += 1
+            else:
+                process.sample()
+
+    def close(self):
+        with self.lock:
+            processes = list(self.processes.values())
+        for process in processes:
+            process.close()
+
+    def stats(self):
+        with self.lock:
+            processes = list(self.processes.values())
+        finished = self.started - len(processes)
+        return {
+            "running": len(processes),
+            "max": self.max_processes,
+            "waiting": self.waiting,
+            "started": self.started,
+            "rejected": self.rejected,
+            "reaped": self.reaped,
+            "rss": sum(process.peak_rss for process in processes),
+            "oldest": max((process.age() for process in processes), default=0.0),
+            "avg_lifetime": self.total_lifetime / finished if finished else 0.0,
+            "cpu": self.total_cpu,
+        }
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from metrics import METRICS
+
+
+class BlockReport:
+    """One time the event loop was blocked past the threshold."""
+
+    __slots__ = ("at", "lag", "task", "stack")
+
+    def __init__(self, at, lag, task, stack):
+        self.at = at
+        self.lag = lag
+        # name of the asyncio task that was running, see task_label()
+        self.task = task
+        self.stack = stack
+
+
+def task_label(task):
+    """What a task is doing, for the reports: commands, players and background work
+    name their task after the command or event and the guild (set_name)."""
+    if task is None:
+        return "callback outside a task"
+    return task.get_name()
+
+
+# Where the event loop runs callbacks and task steps, the frames above it are the loop's own
+LOOP_DISPATCH = os.path.join("asyncio", "events.py")
+
+
+def loop_stack(frame):
+    """The stack of the loop thread from the callback or task it's running."""
+    stack = traceback.extract_stack(frame)
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i].filename.endswith(LOOP_DISPATCH):
+            stack = stack[i + 1:]
+            break
+    return "".join(traceback.format_list(stack))
+
+
+class LoopWatchdog:
+    """Thread that pings the event loop every `interval` seconds and measures how long
+    the loop takes to answer. Every measurement goes to the loop_lag metric; when
+    the loop doesn't answer within `threshold` seconds the watchdog grabs the stack
+    of the loop thread right then (the code that is blocking it) and the task that
+    was running, and logs them once the loop answers, with the total lag."""
+
+    def __init__(self, loop, interval=0.1, threshold=0.25, keep=20):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.reports = deque(maxlen=keep)
+        self.blocked = 0
+        self.worst = 0.0
+        self.loop_thread = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Call from the event loop's thread."""
+        self.loop_thread = threading.get_ident()
+        self.thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = loop_stack(frame) if frame else ""
+        try:
+            task = task_label(asyncio.current_task(self.loop))
+        except RuntimeError:
+            task = "?"
+        return task, stack
+
+    def _run(self):
+        answered = threading.Event()
+        while not self.stopping.is_set():
+            answered.clear()
+            sent = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                # the loop is closed
+                return
+            captured = None
+            if not answered.wait(self.threshold):
+                captured = self._capture()
+                while not answered.wait(1.0):
+                    if self.stopping.is_set():
+                        return
+            lag = time.monotonic() - sent
+            METRICS.observe("loop_lag", lag)
+            if captured:
+                self._report(lag, *captured)
+            self.stopping.wait(self.interval)
+
+    def _report(self, lag, task, stack):
+        self.blocked += 1
+        self.worst = max(self.worst, lag)
+        METRICS.count("loop_blocked")
+        self.reports.append(BlockReport(time.time(), lag, task, stack))
+        print(f"event loop blocked for {lag:.2f}s in {task}, stack at {self.threshold:.2f}s:\n{stack}", end="")
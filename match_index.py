@@ -0,0 +1,111 @@
+import re
+import sqlite3
+import time
+from collections import namedtuple
+
+SPOTIFY_TRACK_ID_RE = re.compile(r"(?:track[/:])?([A-Za-z0-9]{22})")
+
+Match = namedtuple('Match', ('video_id', 'title', 'thumb', 'duration'))
+
+
+def spotify_track_id(text):
+    """Return the track id of a Spotify track link, uri or bare id, or None."""
+    match = SPOTIFY_TRACK_ID_RE.search(text or "")
+    return match.group(1) if match else None
+
+
+class MatchIndex:
+    """On-disk index of the YouTube video chosen for each Spotify track.
+
+    Rows are keyed by Spotify track id and also looked up by ISRC, so the same
+    recording found on another album or playlist doesn't need a new search.
+    Queries are tiny and local, so it's used straight from the event loop. New
+    matches are held in memory and written in one transaction per `batch_size`
+    of them or when flush() is called, not committed one by one."""
+
+    def __init__(self, path, batch_size=100):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode, commits don't wait on an fsync (checkpoints still do); losing the
+        # last matches to a power cut only costs a new search
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            " spotify_id TEXT PRIMARY KEY,"
+            " isrc TEXT,"
+            " video_id TEXT NOT NULL,"
+            " title TEXT,"
+            " thumb TEXT,"
+            " duration REAL,"
+            " updated_at INTEGER NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS matches_isrc ON matches (isrc)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS matches_video_id ON matches (video_id)")
+        self.db.commit()
+        self.batch_size = batch_size
+        # spotify_id -> row not written yet
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup_pending(self, spotify_id, isrc):
+        row = self.pending.get(spotify_id) if spotify_id else None
+        if not row and isrc:
+            row = next((row for row in self.pending.values() if row[1] == isrc), None)
+        return row and row[2:6]
+
+    def lookup(self, spotify_id, isrc=None):
+        row = self._lookup_pending(spotify_id, isrc) if self.pending else None
+        if not row and spotify_id:
+            row = self.db.execute(
+                "SELECT video_id, title, thumb, duration FROM matches WHERE spotify_id = ?", (spotify_id,)
+            ).fetchone()
+        if not row and isrc:
+            row = self.db.execute(
+                "SELECT video_id, title, thumb, duration FROM matches WHERE isrc = ? LIMIT 1", (isrc,)
+            ).fetchone()
+        if row:
+            self.hits += 1
+            return Match(*row)
+        self.misses += 1
+        return None
+
+    def store(self, spotify_id, isrc, video_id, title=None, thumb=None, duration=None):
+        if not spotify_id or not video_id:
+            return
+        self.pending[spotify_id] = (spotify_id, isrc, video_id, title, thumb, duration, int(time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the matches stored since the last flush, in one transaction."""
+        if not self.pending:
+            return
+        rows, self.pending = list(self.pending.values()), {}
+        self.db.executemany("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def forget(self, spotify_id):
+        """Drop the match of a Spotify track (and of every track sharing its ISRC)."""
+        self.flush()
+        cursor = self.db.execute(
+            "DELETE FROM matches WHERE spotify_id = ?"
+            " OR isrc IN (SELECT isrc FROM matches WHERE spotify_id = ? AND isrc IS NOT NULL)",
+            (spotify_id, spotify_id),
+        )
+        self.db.commit()
+        return cursor.rowcount
+
+    def forget_video(self, video_id):
+        """Drop every Spotify track matched to a YouTube video."""
+        self.flush()
+        cursor = self.db.execute("DELETE FROM matches WHERE video_id = ?", (video_id,))
+        self.db.commit()
+        return cursor.rowcount
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+
+    def stats(self):
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
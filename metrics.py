@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Upper bounds (seconds) of the latency histogram buckets, the last one is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "musicbot"
+
+
+class Histogram:
+    """Latency distribution over fixed BUCKETS, like a Prometheus histogram."""
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated inside its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def copy(self):
+        other = Histogram()
+        other.counts = list(self.counts)
+        other.count, other.sum, other.max = self.count, self.sum, self.max
+        return other
+
+
+def _series_order(item):
+    # global series first, then by stage or name: the lines of a family must be contiguous
+    (name, guild), _ = item
+    return guild is not None, name, guild or 0
+
+
+class Metrics:
+    """Latency histograms of the stages a track goes through (extraction, Spotify, voice
+    connect, FFmpeg startup, player message edits, commands) and event counters, each
+    kept globally and per guild. observe() and count() may be called from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (stage, guild_id) -> Histogram, guild_id None is the global one
+        self.histograms = {}
+        # (name, guild_id) -> int
+        self.counters = {}
+
+    def observe(self, stage, seconds, guild_id=None):
+        with self.lock:
+            keys = ((stage, None), (stage, guild_id)) if guild_id is not None else ((stage, None),)
+            for key in keys:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(seconds)
+
+    def count(self, name, guild_id=None, n=1):
+        with self.lock:
+            self.counters[name, None] = self.counters.get((name, None), 0) + n
+            if guild_id is not None:
+                self.counters[name, guild_id] = self.counters.get((name, guild_id), 0) + n
+
+    @contextmanager
+    def timer(self, stage, guild_id=None):
+        """Observe how long the block took, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, guild_id)
+
+    def snapshot(self, guild_id=None):
+        """({stage: Histogram}, {name: count}) of one guild, or the global ones."""
+        with self.lock:
+            histograms = {stage: h.copy() for (stage, guild), h in self.histograms.items() if guild == guild_id}
+            counters = {name: n for (name, guild), n in self.counters.items() if guild == guild_id}
+        return histograms, counters
+
+    def prometheus(self):
+        """Every metric in the Prometheus text exposition format. The global series have
+        no guild label, the per guild ones are separate metric families."""
+        with self.lock:
+            histograms = sorted(((key, h.copy()) for key, h in self.histograms.items()), key=_series_order)
+            counters = sorted(self.counters.items(), key=_series_order)
+
+        lines = []
+        declared = set()
+        for (stage, guild), histogram in histograms:
+            family = f"{PREFIX}_stage_seconds" if guild is None else f"{PREFIX}_guild_stage_seconds"
+            labels = f'stage="{stage}"' if guild is None else f'stage="{stage}",guild="{guild}"'
+            if family not in declared:
+                declared.add(family)
+                lines.append(f"# TYPE {family} histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += n
+                lines.append(f'{family}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{family}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{family}_count{{{labels}}} {histogram.count}")
+        for (name, guild), n in counters:
+            family = f"{PREFIX}_{name}_total" if guild is None else f"{PREFIX}_guild_{name}_total"
+            if family not in declared:
+                declared.add(family)
+                lines.append(f"# TYPE {family} counter")
+            lines.append(f"{family} {n}" if guild is None else f'{family}{{guild="{guild}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class MetricsServer:
+    """Serves METRICS at http://host:port/metrics for Prometheus to scrape, along with
+    the gauges `gauges()` returns ({name: value}, read at scrape time)."""
+
+    def __init__(self, metrics, host, port, gauges=None):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.gauges = gauges
+        self.runner = None
+
+    async def _handle(self, request):
+        body = self.metrics.prometheus()
+        if self.gauges:
+            for name, value in self.gauges().items():
+                body += f"# TYPE {PREFIX}_{name} gauge\n{PREFIX}_{name} {value}\n"
+        return web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
@@ -1,13 +1,25 @@
 import asyncio
+import functools
+import time
+from collections import deque
 import discord
-from discord.ext import commands
-import yt_dlp
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from discord.ext import commands, tasks
 import os
 from discord.ui import View, Button, Select
 import utilities
 import CarrotButton
+from audio_cache import AudioCache
+from match_index import MatchIndex, spotify_track_id
+from spotify_client import AsyncSpotify, SpotifyError
+from ffmpeg_governor import ENCODING_STATS, FFmpegGovernor, FFmpegSaturated
+from metrics import METRICS, MetricsServer
+from loop_watchdog import LoopWatchdog
+from profiler import SamplingProfiler
+from player import CLEAR, JUMP, MOVE, PAUSE, PLAY, PREVIOUS, REMOVE, RESUME, SHUFFLE, SKIP, Player, PlayerMessage, TrackSource
+from extraction import (
+    create_backend, extraction_key, ExtractionScheduler, ExtractionRejected, SingleFlight,
+    PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, PRIORITY_BULK,
+)
 
 import os
 from dotenv import load_dotenv
@@ -15,16 +27,31 @@ from dotenv import load_dotenv
 load_dotenv()
 FFMPEG_PATH = os.getenv("FFMPEG_PATH")
 
-# Optimized FFmpeg options: reconnect + explicit audio parameters (48kHz, stereo, 96kbps Opus) 
-FFMPEG_OPTIONS = { 
-    "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5", 
-    "options": "-vn -ar 48000 -ac 2 -b:a 96k -compression_level 5 -application audio" 
+# Encoding profiles: (Opus bitrate in kbps, extra FFmpeg output options). FFmpegOpusAudio
+# already outputs 48kHz stereo Opus, these tune the encoder for the CPU it costs
+ENCODING_PROFILES = {
+    "low": (64, "-vn -compression_level 2 -application audio"),
+    "standard": (96, "-vn -compression_level 5 -application audio"),
+    "high": (128, "-vn -compression_level 10 -application audio"),
 }
+ENCODING_PROFILE = os.getenv("ENCODING_PROFILE", "standard")
+# Streams that already are 48kHz Opus (most YouTube audio, see YDL_OPTS) are remuxed
+# as they are instead of decoded and encoded again. OPUS_PASSTHROUGH=0 always encodes
+OPUS_PASSTHROUGH = os.getenv("OPUS_PASSTHROUGH", "1") != "0"
+# FFmpeg processes allowed at once (playing and pre-spawned), seconds a track waits for
+# one before giving up, free memory (MB) below which none is started, and hours after
+# which one is killed whatever it's doing
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", 64))
+FFMPEG_QUEUE_TIMEOUT = float(os.getenv("FFMPEG_QUEUE_TIMEOUT", 15))
+FFMPEG_MIN_FREE_MB = int(os.getenv("FFMPEG_MIN_FREE_MB", 256))
+FFMPEG_MAX_LIFETIME = float(os.getenv("FFMPEG_MAX_LIFETIME_HOURS", 6)) * 3600
 FFMPEG_BEFORE_OPTIONS = ( "-reconnect 1 " "-reconnect_streamed 1 " "-reconnect_delay_max 5" ) 
 # ---------- yt-dlp options (lower bitrate, explicit node path, SABR-safe clients) ---------- 
 YDL_OPTS = { # prefer Opus <= 128kbps, fallback to other opus / best audio 
     "format": "ba[acodec=opus][abr<=128]/ba[acodec=opus]/bestaudio/best", 
     "noplaylist": False, 
+    # playlists (and searches) only list their entries, stream urls are resolved when a track is about to play
+    "extract_flat": "in_playlist",
     "quiet": True, 
     "extractor_args": { 
         "youtube": { 
@@ -38,6 +65,57 @@ YDL_OPTS = { # prefer Opus <= 128kbps, fallback to other opus / best audio
 
 
 EMBED_QUEUE_MAX_TITLE_LENGTH = 50
+# Tracks the player embed shows (from QUEUE_WINDOW_BEFORE before the current one), and per ]queue page
+QUEUE_WINDOW = 10
+QUEUE_WINDOW_BEFORE = 2
+QUEUE_PAGE_SIZE = 10
+# Discord's limits on an embed field value and an embed description
+EMBED_FIELD_LIMIT = 1024
+EMBED_DESCRIPTION_LIMIT = 4096
+
+# Where yt-dlp runs: "thread" (YoutubeDL pool on threads) or "process" (one YoutubeDL
+# per worker process, doesn't contend for the GIL), and how many workers it gets
+EXTRACTION_BACKEND = os.getenv("EXTRACTION_BACKEND", "thread")
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", 8))
+# Max number of playlist entries extracted at the same time
+PLAYLIST_RESOLVE_CONCURRENCY = int(os.getenv("PLAYLIST_RESOLVE_CONCURRENCY", 8))
+# Refresh the player embed every N tracks added by a background playlist import
+PLAYER_REFRESH_EVERY = 10
+# Minimum seconds between two edits of a session's player message
+PLAYER_EDIT_INTERVAL = 2.0
+# Number of upcoming tracks whose stream url is resolved ahead of time
+PREFETCH_AHEAD = 2
+
+# Sessions untouched for this long (seconds) while nothing plays are torn down
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", 30 * 60))
+
+# Seconds before the end of a track at which the next one's FFmpeg is spawned,
+# and how many frames (20 ms each) it reads ahead so it starts without a gap
+PRESPAWN_LEAD = 10
+PREBUFFER_FRAMES = 50
+
+# Local Prometheus endpoint (http://METRICS_HOST:METRICS_PORT/metrics), METRICS_PORT=0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# The event loop not answering for this long (seconds) gets its stack logged, see LoopWatchdog
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", 0.25))
+
+# ]profile: seconds between samples, longest run allowed, where the collapsed stacks are written
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 120))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Resolved stream urls shared by every guild, see utilities.StreamCache
+STREAM_CACHE = utilities.StreamCache(max_entries=int(os.getenv("STREAM_CACHE_SIZE", 2048)))
+
+# Spotify track -> YouTube video matches, kept across restarts
+# Opus packets of played tracks, replayed from disk. AUDIO_CACHE_BYTES=0 turns it off
+AUDIO_CACHE = AudioCache(
+    os.getenv("AUDIO_CACHE_DIR", "audio_cache"),
+    int(os.getenv("AUDIO_CACHE_BYTES", 2 * 1024 ** 3)),
+)
+MATCH_INDEX = MatchIndex(os.getenv("MATCH_INDEX_PATH", "match_index.sqlite3"))
 
 
 class Music(commands.Cog):
@@ -51,122 +129,354 @@ class Music(commands.Cog):
         return "spotify.com" in text
 
     async def fetch_video_info(self, loop, ctx, arg, is_url): 
+        video_id = utilities.youtube_video_id(arg) if is_url else None
+        cached = STREAM_CACHE.get(video_id) if video_id else None
+        if cached:
+            return {
+                "id": video_id,
+                "title": cached.title,
+                "thumbnail": cached.thumb,
+                "duration": cached.duration,
+                "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+                "audio_url": cached.url,
+                "acodec": cached.acodec,
+                "asr": cached.asr,
+            }
         try: 
-            return await loop.run_in_executor(None, self._extract_info_sync, arg, is_url) 
+            info = await self.extract(loop, arg, is_url, ctx.guild.id, PRIORITY_INTERACTIVE) 
+        except ExtractionRejected as e:
+            METRICS.count("extractions_rejected", ctx.guild.id)
+            await ctx.send("Muita coisa na fila de extração, tenta de novo daqui a pouco.")
+            print("yt-dlp extract rejected:", e)
+            return None
         except Exception as e: 
+            METRICS.count("extraction_errors", ctx.guild.id)
             await ctx.send("Erro ao extrair informações do YouTube.") 
             print("yt-dlp extract error:", e) 
             return None
+        if info and info.get("_type") != "playlist":
+            self.remember_stream(info)
+        return info
+
+    async def extract(self, loop, query, is_url, guild_id, priority):
+        """ Extract through the scheduler, sharing the result with identical requests already in flight. """
+        # what a user waits on is timed apart from prefetches and playlist imports
+        stage = "extract" if priority == PRIORITY_INTERACTIVE else "extract_background"
+        key = extraction_key(query, is_url)
+        with METRICS.timer(stage, guild_id):
+            # joining one still waiting at a lower priority (a prefetch, a playlist import) moves it up
+            self.scheduler.promote(key, priority)
+            return await self.in_flight.do(
+                key,
+                lambda: self.scheduler.extract(loop, query, is_url, guild_id, priority, key)
+            )
+
+    def remember_stream(self, info):
+        """ Store the stream url of an extracted video in STREAM_CACHE and return its StreamEntry. """
+        return STREAM_CACHE.put(
+            info.get("id"), info.get("audio_url"), info.get("title"), info.get("thumbnail"),
+            info.get("duration"), info.get("acodec"), info.get("asr"),
+        )
+
+    async def _fetch_stream(self, loop, session, link, priority):
+        info = await self.extract(loop, link, True, session.guild.id, priority)
+        return self.remember_stream(info)
+
+    def _track_from_info(self, info, link=None):
+        """ Build the (title, video_id, thumb, link, duration) queue record of a flat or
+        fully extracted video. The stream url is not part of it, see resolve_stream. """
+        link = link or info.get("webpage_url") or info.get("original_url") or info.get("url")
+        if not link:
+            return None
+        thumb = info.get("thumbnail")
+        if not thumb and info.get("thumbnails"):
+            thumb = info["thumbnails"][0].get("url")
+        return info.get("title", "Unknown title"), info.get("id"), thumb, link, info.get("duration")
+
+    async def resolve_stream(self, loop, session, track):
+        """ Return the StreamEntry (audio stream url and format) of a queued track: from
+        STREAM_CACHE, from a prefetch already in flight, or extracted just in time. """
+        cached = STREAM_CACHE.get(track.video_id)
+        pending = session.prefetched.pop(track.link, None)
+        if cached:
+            if pending:
+                pending.cancel()
+            return cached
+        if pending is None:
+            pending = loop.create_task(self._fetch_stream(loop, session, track.link, PRIORITY_INTERACTIVE))
+        try:
+            return await pending
+        except Exception as e:
+            print("yt-dlp extract error:", track.link, e)
+            return None
+
+    def prefetch_upcoming(self, loop, session):
+        """ Start resolving the stream urls of the next PREFETCH_AHEAD tracks in the background. """
+        upcoming = {track.link: track for track in session.q.upcoming(PREFETCH_AHEAD)}
+        for link in list(session.prefetched):
+            if link not in upcoming:
+                session.prefetched.pop(link).cancel()
+        for link, track in upcoming.items():
+            if link not in session.prefetched and track.video_id not in STREAM_CACHE and track.video_id not in AUDIO_CACHE:
+                session.prefetched[link] = loop.create_task(self._fetch_stream(loop, session, link, PRIORITY_PREFETCH))
+
+    async def _spawn_source(self, guild_id, stream, track, wait=True):
+        """ Start FFmpeg on a stream through the governor, may raise FFmpegSaturated. """
+        log = utilities.FFmpegLog()
+        if OPUS_PASSTHROUGH and stream.acodec == "opus" and stream.asr == 48000:
+            # Already what Discord wants, FFmpeg only moves the packets from WebM to Ogg
+            mode, codec, bitrate, options = "copy", "copy", None, "-vn"
+        else:
+            mode, codec = self.encoding_profile, None
+            bitrate, options = ENCODING_PROFILES[mode]
+        with METRICS.timer("ffmpeg_spawn", guild_id):
+            process = await self.ffmpeg.spawn(guild_id, mode, lambda: discord.FFmpegOpusAudio( 
+                stream.url, 
+                executable=FFMPEG_PATH, 
+                before_options=FFMPEG_BEFORE_OPTIONS, 
+                codec=codec,
+                bitrate=bitrate,
+                options=options,
+                stderr=log
+            ), wait=wait)
+        return TrackSource(
+            process.audio, track.link, track.duration, log,
+            AUDIO_CACHE.recorder(track.video_id, track.duration), process,
+        )
+
+    def _cached_source(self, track):
+        inner = AUDIO_CACHE.open(track.video_id)
+        return TrackSource(inner, track.link, track.duration) if inner else None
+
+    def _start_source(self, loop, session, source):
+        self.prefetch_upcoming(loop, session)
+        source.notify_near_end(PRESPAWN_LEAD, lambda: loop.call_soon_threadsafe(self.prespawn_next, loop, session))
+        return source
+
+    async def create_source(self, loop, session):
+        """ Return the source of the current track: the one pre-spawned while the previous
+        track was ending if it's still the right one, else the track from AUDIO_CACHE,
+        else a freshly spawned FFmpeg.
+        Tracks whose audio can't be extracted are skipped. Returns None if nothing
+        in the queue is playable, raises FFmpegSaturated if FFmpeg can't be started. """
+        prepared = session.take_next_source()
+        current = session.q.current_music
+        if prepared and current and prepared.link == current.link:
+            return self._start_source(loop, session, prepared)
+        if prepared:
+            prepared.cleanup()
+
+        for _ in range(len(session.q)):
+            cached = self._cached_source(session.q.current_music)
+            if cached:
+                return self._start_source(loop, session, cached)
+            stream = await self.resolve_stream(loop, session, session.q.current_music)
+            if stream:
+                source = await self._spawn_source(session.guild.id, stream, session.q.current_music)
+                return self._start_source(loop, session, source)
+            if not session.q.next():
+                break
+        return None
+
+    def prespawn_next(self, loop, session):
+        """ Called when the current track is about to end: get the next one ready. """
+        upcoming = session.q.upcoming(1)
+        if upcoming and not session.next_source:
+            self.spawn_background(session, self.prepare_next_source(loop, session, upcoming[0]))
+
+    async def prepare_next_source(self, loop, session, track):
+        source = self._cached_source(track)
+        if not source:
+            stream = await self.resolve_stream(loop, session, track)
+            if not stream:
+                return
+            try:
+                # only with a slot free right away, else the track spawns when it starts
+                source = await self._spawn_source(session.guild.id, stream, track, wait=False)
+            except FFmpegSaturated:
+                return
+            prebuffer = loop.run_in_executor(None, source.prebuffer, PREBUFFER_FRAMES)
+            try:
+                # shielded: cancelling this task must not mark prebuffer done while its thread still reads
+                await asyncio.shield(prebuffer)
+            except BaseException:
+                # kill FFmpeg and drop the buffer only once the thread is done with them
+                prebuffer.add_done_callback(lambda _: source.cleanup())
+                raise
+        # The queue may have moved on while FFmpeg was starting
+        upcoming = session.q.upcoming(1)
+        if upcoming and upcoming[0].link == track.link and not session.next_source:
+            session.next_source = source
+        else:
+            source.cleanup()
+
+    def _spotify_query(self, track_info) -> str:
+        artists = ", ".join(a["name"] for a in track_info["artists"])
+        return f"{track_info['name']} {artists}"
+
+    def spawn_background(self, session, coro):
+        """ Run coro as a task owned by the session, so it can be cancelled with it. """
+        task = asyncio.ensure_future(coro)
+        task.set_name(f"{coro.__qualname__} in guild {session.guild.id}")
+        session.tasks.add(task)
+        task.add_done_callback(session.tasks.discard)
+        return task
+
+    async def resolve_entries(self, items, resolve, limit=PLAYLIST_RESOLVE_CONCURRENCY):
+        """ Run `resolve(item)` for every item of the async iterable `items`, with at most
+        `limit` in flight. Items are pulled as they come, so resolving starts while
+        the source is still producing (e.g. loading the next Spotify page).
+
+        Yields (item, info, error) tuples in the order of items, each one as soon
+        as it and everything before it is ready. """
+        pending = deque()
+
+        async def head():
+            item, task = pending.popleft()
+            try:
+                return item, await task, None
+            except Exception as e:
+                return item, None, e
+
+        try:
+            async for item in items:
+                pending.append((item, asyncio.ensure_future(resolve(item))))
+                while len(pending) >= max(1, limit):
+                    yield await head()
+            while pending:
+                yield await head()
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def enqueue_remaining(self, ctx, session, items, resolve):
+        """ Background half of a playlist import: resolve the remaining entries and
+        append them to the queue in order while the first track is already playing. """
+        failures = 0
+        added = 0
+        try:
+            async for item, info, error in self.resolve_entries(items, resolve):
+                track = self._track_from_info(info) if info else None
+                if not track:
+                    failures += 1
+                    print("yt-dlp extract error:", error or "no result")
+                    continue
+                session.q.enqueue(*track)
+                added += 1
+                if session.player and session.player.exhausted:
+                    # the queue ran out before the import caught up, carry on with the new tracks
+                    session.player.post(PLAY, ctx)
+                if added % PLAYER_REFRESH_EVERY == 0:
+                    self.refresh_player_message(session)
+        except SpotifyError as e:
+            print("spotify error:", e)
+            await ctx.send("Erro ao carregar o resto da playlist do Spotify.")
+
+        self.refresh_player_message(session)
+        if failures:
+            await ctx.send(f"Erro: Não consegui pegar audio de {failures} faixa(s) da playlist.")
+
+    async def start_playback_if_idle(self, ctx, session, loop, voice_channel):
+        # ]leave, a kick or idle eviction closed the session while the command was extracting
+        if session.closed:
+            return
+        # ---------------- VOICE CONNECTION ---------------- 
+        if not ctx.voice_client:
+            try: 
+                await self.connect_voice(ctx.guild, voice_channel)
+            except Exception as e: 
+                await ctx.send("Erro ao conectar no canal de voz.") 
+                print("connect error:", e) 
+                return
 
-    def _extract_audio_url_from_info(self, info) -> str | None: 
-        """ Given a fully-extracted yt-dlp video info dict, return a direct audio-only stream URL. """ 
-        formats = info.get("formats", []) or [] 
-        audio_formats = [ 
-            f for f in formats 
-            if f.get("acodec") 
-            and f.get("acodec") != "none" 
-            and (not f.get("vcodec") or f.get("vcodec") == "none") 
-            and f.get("url") 
-        ] 
-        if not audio_formats: 
-            return None 
-
-        # Prefer highest abr (already capped by YDL_OPTS) 
-        best = max(audio_formats, key=lambda f: f.get("abr") or 0) 
-        return best["url"]
-
-    def _extract_info_sync(self, query, is_url): 
-        """Run inside a thread: create YoutubeDL and extract info synchronously.""" 
-        with yt_dlp.YoutubeDL(YDL_OPTS) as ydl: 
-            if is_url: 
-                return ydl.extract_info(query, download=False) 
-            else: 
-                return ydl.extract_info(f"ytsearch:{query}", download=False)['entries'][0]
+        # ---------------- START PLAYBACK IF IDLE ---------------- 
+        player = self.get_player(session)
+        if player:
+            await player.request(PLAY, ctx)
 
     async def handle_youtube(self, ctx, arg, session, loop, is_url, voice_channel, spotify_playlist_search): 
         info = await self.fetch_video_info(loop, ctx, arg, is_url) 
         if not info: 
-            return 
+            return 0
         # print("info:",info) 
         tracks_added = 0 
-        thumb = None 
-        title = "Unknown title" 
         # ---------------- PLAYLIST HANDLING ---------------- 
         if info.get("_type") == "playlist": 
-            entries = info.get("entries", []) 
-            for entry in entries: 
-                if not entry or not entry.get("original_url"): 
-                    continue 
-                info = await self.fetch_video_info(loop, ctx, entry.get("original_url"), True) 
-                audio_url = self._extract_audio_url_from_info(info) 
-                if not audio_url: 
-                    await ctx.send("Erro: Não consegui pegar audio do YouTube.") 
-                    continue
-                title = info.get("title", "Unknown title") 
-                thumb = None 
-                if info.get("thumbnails"): 
-                    thumb = info["thumbnails"][0].get("url") 
-                session.q.enqueue(title, audio_url, thumb, entry.get("original_url")) 
-                tracks_added += 1 
+            # Flat extraction: entries only carry metadata, so the whole playlist is queued at once
+            tracks = (self._track_from_info(entry) for entry in info.get("entries") or [] if entry)
+            tracks_added = session.q.enqueue_many(track for track in tracks if track)
+            if not tracks_added:
+                await ctx.send("Erro: Não consegui pegar audio do YouTube.")
+                return 0
         # ---------------- SINGLE VIDEO ---------------- 
         else: 
-            audio_url = self._extract_audio_url_from_info(info) 
-            if not audio_url: 
+            track = self._track_from_info(info)
+            if not track:
                 await ctx.send("Erro: Não consegui pegar audio do YouTube.") 
                 return 0
-            title = info.get("title", "Unknown title") 
-            thumb = None 
-            if info.get("thumbnails"): 
-                thumb = info["thumbnails"][0].get("url") 
-            session.q.enqueue(title, audio_url, thumb, info.get("original_url")) 
+            session.q.enqueue(*track)
             tracks_added = 1 
-        # ---------------- VOICE CONNECTION ---------------- 
-        if not ctx.voice_client:
-            try: 
-                vc = await voice_channel.connect() 
-            except Exception as e: 
-                await ctx.send("Erro ao conectar no canal de voz.") 
-                print("connect error:", e) 
-                return tracks_added
-        else: 
-            vc = ctx.voice_client 
-
-        # ---------------- START PLAYBACK IF IDLE ---------------- 
-        if not vc.is_playing(): 
-            session.q.set_first_as_current() 
-            source = discord.FFmpegOpusAudio( 
-                session.q.current_music.url, 
-                executable=FFMPEG_PATH, 
-                before_options=FFMPEG_BEFORE_OPTIONS, 
-                options=FFMPEG_OPTIONS 
-            )
-            vc.play(source, after=lambda e: self.prepare_continue_queue(ctx)) 
-            # print(session.q.queue) 
-            # if tracks_added == 1 and not spotify_playlist_search: 
-                # if thumb: 
-                    # await ctx.send(thumb) 
-                    # await ctx.send(f"Tocando agora: {title}") 
+        await self.start_playback_if_idle(ctx, session, loop, voice_channel)
+        # if tracks_added == 1 and not spotify_playlist_search: 
+            # if thumb: 
+                # await ctx.send(thumb) 
+                # await ctx.send(f"Tocando agora: {title}") 
         return tracks_added
 
+    async def match_spotify_track(self, loop, guild_id, priority, track_info):
+        """ Return a flat info dict of the YouTube video matching a Spotify track,
+        from MATCH_INDEX when it was matched before, else from a YouTube search. """
+        spotify_id = track_info.get("id")
+        isrc = (track_info.get("external_ids") or {}).get("isrc")
+        match = MATCH_INDEX.lookup(spotify_id, isrc)
+        if match:
+            return {
+                "id": match.video_id,
+                "title": match.title,
+                "thumbnail": match.thumb,
+                "duration": match.duration,
+                "url": f"https://www.youtube.com/watch?v={match.video_id}",
+            }
+
+        info = await self.extract(loop, self._spotify_query(track_info), False, guild_id, priority)
+        track = self._track_from_info(info)
+        if track and track[1]:
+            MATCH_INDEX.store(spotify_id, isrc, track[1], track[0], track[2], track[4])
+        return info
+
     async def handle_spotify(self, ctx, arg, session, loop, is_url, voice_channel): 
-        tracks_added = 0 
-        # ---------------- PLAYLIST HANDLING ---------------- 
-        if "playlist" in arg: 
-            results = spotify.playlist_items(arg) 
-            for item in results["items"]: 
-                track_info = item["track"] 
-                query = f"{track_info['name']} {', '.join(map(lambda a: a["name"], track_info['artists']))}" 
-                tracks_added += await self.handle_youtube(ctx, query, session, loop, False, voice_channel, True) 
-        elif "album" in arg: 
-            results = spotify.album_tracks(arg) 
-            for track_info in results["items"]: 
-                query = f"{track_info['name']} {', '.join(map(lambda a: a["name"], track_info['artists']))}" 
-                tracks_added += await self.handle_youtube(ctx, query, session, loop, False, voice_channel, True) 
-        else: 
-            track_info = spotify.track(arg) 
-            query = f"{track_info['name']} {', '.join(map(lambda a: a["name"], track_info['artists']))}" 
-            tracks_added += await self.handle_youtube(ctx, query, session, loop, False, voice_channel, False) 
-        return tracks_added
+        # Tracks stream in page by page (a single track, album or whole playlist)
+        tracks = self.spotify.tracks(arg)
+        requested_at = time.perf_counter()
+
+        # Match the first track right away so playback can start, the rest streams in afterwards
+        try:
+            async for track_info in tracks:
+                if requested_at:
+                    # how long Spotify took to give the first track
+                    METRICS.observe("spotify", time.perf_counter() - requested_at, ctx.guild.id)
+                    requested_at = None
+                try:
+                    info = await self.match_spotify_track(loop, ctx.guild.id, PRIORITY_INTERACTIVE, track_info)
+                except Exception as e:
+                    print("yt-dlp extract error:", e)
+                    continue
+                track = self._track_from_info(info)
+                if not track:
+                    continue
+                session.q.enqueue(*track)
+                resolve = functools.partial(self.match_spotify_track, loop, ctx.guild.id, PRIORITY_BULK)
+                self.spawn_background(session, self.enqueue_remaining(ctx, session, tracks, resolve))
+                await self.start_playback_if_idle(ctx, session, loop, voice_channel)
+                return 1
+        except SpotifyError as e:
+            print("spotify error:", e)
+            METRICS.count("spotify_errors", ctx.guild.id)
+            await ctx.send("Erro ao acessar o Spotify.")
+            return 0
+
+        await ctx.send("Erro ao extrair informações do YouTube.")
+        return 0
 
 
     
@@ -175,13 +485,11 @@ class Music(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
-        self.sessions = []
+        self.sessions = utilities.SessionRegistry()
 
-        self.spotify = spotipy.Spotify(
-            auth_manager=SpotifyClientCredentials(
-                client_id=os.getenv("spotifyClientID"),
-                client_secret=os.getenv("spotifyClientSecret"),
-            )
+        self.spotify = AsyncSpotify(
+            client_id=os.getenv("spotifyClientID"),
+            client_secret=os.getenv("spotifyClientSecret"),
         )
 
         self.FFMPEG_OPTIONS = {
@@ -196,94 +504,197 @@ class Music(commands.Cog):
             "quiet": True,
         }
 
-    # ---------- helpers ----------
-
-    def check_session(self, ctx):
-        for s in self.sessions:
-            if s.guild == ctx.guild and s.channel == ctx.author.voice.channel:
-                return s
-
-        session = utilities.Session(ctx.guild, ctx.author.voice.channel, id=len(self.sessions))
-        self.sessions.append(session)
-        return session
-
-
-
-    def prepare_continue_queue(self, ctx): 
-        session = self.check_session(ctx)
-        if session.q.hasnext():
-            session.q.next()
-        else:
-            session.end_of_queue = True
-        fut = asyncio.run_coroutine_threadsafe(self.continue_queue(ctx), self.bot.loop) 
-        try: 
-            fut.result() 
-        except Exception as e: 
-            print("prepare_continue_queue error:", e) 
-
-    async def continue_queue(self, ctx): 
-        session = self.check_session(ctx) 
-        if session.is_paused: 
-            return 
-
-        if not session.q.loop and session.end_of_queue:
-            await ctx.send("Acabou a queue, brother.") 
-            return 
-
-        if session.q.curr_index == -1:
-            session.q.next()
-
-
-
-        if not session.q.loop and session.q.curr_index == len(session.q)-1:
-            session.end_of_queue = True
+        self.extractor = create_backend(EXTRACTION_BACKEND, YDL_OPTS, EXTRACTION_WORKERS)
+        self.scheduler = ExtractionScheduler(self.extractor, max_running=EXTRACTION_WORKERS)
+        self.in_flight = SingleFlight()
+        self.ffmpeg = FFmpegGovernor(
+            FFMPEG_MAX_PROCESSES, FFMPEG_QUEUE_TIMEOUT, FFMPEG_MIN_FREE_MB * 1024 ** 2, FFMPEG_MAX_LIFETIME
+        )
+        if ENCODING_PROFILE not in ENCODING_PROFILES:
+            raise ValueError(f"unknown encoding profile {ENCODING_PROFILE!r}, expected one of {', '.join(ENCODING_PROFILES)}")
+        self.encoding_profile = ENCODING_PROFILE
+        self.metrics_server = MetricsServer(METRICS, METRICS_HOST, METRICS_PORT, self.metrics_gauges) if METRICS_PORT else None
+        self.watchdog = None
+        self.profiler = None
+
+        # Shared by every player message, only the play/pause button differs
+        self.player_views = {
+            False: CarrotButton.PlayerView(self, paused=False),
+            True: CarrotButton.PlayerView(self, paused=True),
+        }
 
-        voice = discord.utils.get(self.bot.voice_clients, guild=session.guild) 
+    async def cog_load(self):
+        await self.extractor.start(asyncio.get_running_loop())
+        # Both views share their custom_ids, registering one is enough to route every button press
+        self.bot.add_view(self.player_views[False])
+        self.bot.add_dynamic_items(CarrotButton.QueuePageButton)
+        self.evict_idle_sessions.start()
+        self.reap_ffmpeg.start()
+        self.flush_match_index.start()
+        self.watchdog = LoopWatchdog(asyncio.get_running_loop(), threshold=LOOP_LAG_THRESHOLD)
+        self.watchdog.start()
+        if self.metrics_server:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                print("metrics server error:", e)
+
+    async def cog_unload(self):
+        self.bot.remove_dynamic_items(CarrotButton.QueuePageButton)
+        self.evict_idle_sessions.cancel()
+        self.reap_ffmpeg.cancel()
+        self.flush_match_index.cancel()
+        MATCH_INDEX.flush()
+        if self.watchdog:
+            self.watchdog.stop()
+        self.ffmpeg.close()
+        self.extractor.close()
+        await self.spotify.close()
+        if self.metrics_server:
+            await self.metrics_server.close()
+
+    async def cog_before_invoke(self, ctx):
+        ctx.invoked_at = time.perf_counter()
+        # what the loop watchdog reports if this command blocks the loop
+        asyncio.current_task().set_name(f"]{ctx.command.name} in guild {ctx.guild and ctx.guild.id}")
+
+    async def cog_after_invoke(self, ctx):
+        invoked_at = getattr(ctx, "invoked_at", None)
+        if invoked_at is not None and ctx.command:
+            METRICS.observe("command_" + ctx.command.name, time.perf_counter() - invoked_at, ctx.guild and ctx.guild.id)
+
+    def metrics_gauges(self):
+        """Current values exposed next to METRICS on the metrics endpoint."""
+        ffmpeg = self.ffmpeg.stats()
+        scheduler = self.scheduler.stats()
+        return {
+            "sessions": len(self.sessions),
+            "voice_clients": len(self.bot.voice_clients),
+            "ffmpeg_running": ffmpeg["running"],
+            "ffmpeg_waiting": ffmpeg["waiting"],
+            "extractions_running": scheduler["running"],
+            "extractions_waiting": scheduler["waiting"],
+            "stream_cache_entries": len(STREAM_CACHE),
+            "audio_cache_bytes": AUDIO_CACHE.size,
+        }
 
-        if not voice: 
-            # If voice client not found, connect 
-            vc = await session.channel.connect()
-        else: 
-            vc = voice 
+    # ---------- helpers ----------
 
-        try: 
-            source = discord.FFmpegOpusAudio( 
-                session.q.current_music.url, 
-                executable=FFMPEG_PATH, 
-                before_options=FFMPEG_BEFORE_OPTIONS, 
-                options=FFMPEG_OPTIONS 
-            )
-        except Exception as e: 
-            await ctx.send("Erro ao preparar audio (probe).") 
-            print("from_probe error:", e) 
-            return 
+    def check_session(self, ctx):
+        # The bot's voice channel if it's connected, so a button pressed by someone
+        # outside the call still reaches the session that is playing
+        vc = ctx.guild.voice_client
+        channel = vc.channel if vc else ctx.author.voice.channel
+        return self.sessions.get_or_create(ctx.guild, channel)
+
+    def guild_session(self, guild):
+        """The session the bot is playing in a guild, or None."""
+        vc = guild.voice_client
+        return self.sessions.get(guild.id, vc.channel.id) if vc else None
+
+    def get_player(self, session):
+        """The session's Player, created on first use. None once the session is closed:
+        its player task would never be cancelled."""
+        if session.closed:
+            return None
+        if session.player is None:
+            session.player = Player(self, session, self.bot.loop)
+        return session.player
+
+    async def connect_voice(self, guild, channel):
+        with METRICS.timer("voice_connect", guild.id):
+            return await channel.connect()
+
+    def forget_stream(self, video_id):
+        STREAM_CACHE.invalidate(video_id)
+
+    @tasks.loop(minutes=1)
+    async def evict_idle_sessions(self):
+        # a snapshot, evicting removes sessions from the registry
+        for session in list(self.sessions):
+            if session.idle_for() < SESSION_IDLE_TIMEOUT:
+                continue
+            # one failing session must not end the loop (tasks.loop stops on an exception)
+            try:
+                vc = session.guild.voice_client
+                if vc and vc.channel == session.channel:
+                    if vc.is_playing() or vc.is_paused():
+                        continue
+                    await vc.disconnect()
+            except Exception as e:
+                print("idle disconnect error:", e)
+            try:
+                self.sessions.remove(session.guild.id, session.channel.id)
+            except Exception as e:
+                print("idle session close error:", e)
 
-        if vc.is_playing(): 
-            vc.stop() 
+    @tasks.loop(seconds=30)
+    async def reap_ffmpeg(self):
+        self.ffmpeg.reap()
 
-        vc.play(source, after=lambda e: self.prepare_continue_queue(ctx))
+    @tasks.loop(seconds=10)
+    async def flush_match_index(self):
+        # the matches of imports smaller than a batch, see MatchIndex.store
+        MATCH_INDEX.flush()
 
-    def get_embed_view(self, ctx: commands.Context, session):
-        formatted_queue = ""
-        if len(session.q) > 0:
-            for m in range(min(len(session.q), 10)):
-                abb_title = session.q[m][0]
-                if len(abb_title) > EMBED_QUEUE_MAX_TITLE_LENGTH:
-                    abb_title = abb_title[:EMBED_QUEUE_MAX_TITLE_LENGTH-3:]
-                    abb_title += "..."
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        # The bot left (or was kicked from) a voice channel: its session is over
+        if member.id == self.bot.user.id and before.channel and before.channel != after.channel:
+            self.sessions.remove(member.guild.id, before.channel.id)
 
-                index = str(m + 1) + "."
-                if session.q.curr_index == m:
-                    if session.is_paused:
-                        index = "⏸️"
-                    elif session.stopped:
-                        index = "⏹️"
-                    else:
-                        index = "▶️"
 
-                formatted_queue += "\n" + index + " [" + abb_title + "](" + session.q[m][3] + ")"
 
+    def _play_state(self, session):
+        if session.is_paused:
+            return "paused"
+        if session.stopped:
+            return "stopped"
+        return "playing"
+
+    def _queue_line(self, session, index):
+        title = session.q[index].title or "?"
+        if len(title) > EMBED_QUEUE_MAX_TITLE_LENGTH:
+            title = title[:EMBED_QUEUE_MAX_TITLE_LENGTH - 3] + "..."
+        marker = f"{index + 1}."
+        if index == session.q.curr_index:
+            marker = {"paused": "⏸️", "stopped": "⏹️"}.get(self._play_state(session), "▶️")
+        return f"{marker} [{title}]({session.q[index].link})"
+
+    def _queue_lines(self, session, start, end, limit):
+        """Lines of the tracks in [start, end), as many as fit in `limit` characters."""
+        lines = []
+        size = 0
+        for index in range(start, end):
+            line = self._queue_line(session, index)
+            size += len(line) + 1
+            if size > limit:
+                break
+            lines.append(line)
+        return "\n".join(lines) or "Nenhuma faixa na queue."
+
+    def render_queue_window(self, session):
+        """ The tracks around the current one, numbered by their position in the queue. """
+        q = session.q
+        start = max(0, min(q.curr_index - QUEUE_WINDOW_BEFORE, len(q) - QUEUE_WINDOW))
+        return self._queue_lines(session, start, min(len(q), start + QUEUE_WINDOW), EMBED_FIELD_LIMIT)
+
+    def queue_pages(self, session):
+        return max(1, -(-len(session.q) // QUEUE_PAGE_SIZE))
+
+    def render_queue_page(self, session, page):
+        pages = self.queue_pages(session)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        description = session.cached_render(
+            ("page", page, self._play_state(session)),
+            lambda: self._queue_lines(session, start, min(len(session.q), start + QUEUE_PAGE_SIZE), EMBED_DESCRIPTION_LIMIT),
+        )
+        embed = discord.Embed(title="Queue", description=description, color=discord.Color.orange())
+        embed.set_footer(text=f"Página {page}/{pages} · {len(session.q)} faixas")
+        return embed, CarrotButton.QueuePageView(page, pages)
 
+    def get_embed_view(self, session):
         embed_title = "Now Playing"
         if session.is_paused:
             embed_title = "Paused"
@@ -308,73 +719,40 @@ class Music(commands.Cog):
         else:
             embed.set_thumbnail(url="https://t4.ftcdn.net/jpg/02/04/10/95/360_F_204109503_OxuR11rq9CLkEFkjWphOBABSDTBTNJrc.jpg")
 
-        embed.add_field(name="Queue:",value=formatted_queue)
-
-        # view = PlayerView(self, ctx)
-
+        embed.add_field(name="Queue:", value=session.cached_render(("window", self._play_state(session)), lambda: self.render_queue_window(session)))
+        if session.q.current_music:
+            embed.set_footer(text=f"Faixa {session.q.curr_index + 1} de {len(session.q)}")
 
-        view = discord.ui.View()
-        prev_track = CarrotButton.PrevTrackButton(self, ctx, "⏮️", discord.ButtonStyle.secondary, "prev_track")
-        pp_track = None
-        if session.is_paused or session.stopped:
-            pp_track = CarrotButton.PauseResumeTrackButton(self, ctx, "▶️", discord.ButtonStyle.success, "pp_track")
-        else:
-            pp_track = CarrotButton.PauseResumeTrackButton(self, ctx, "⏸️", discord.ButtonStyle.primary, "pp_track")
-
-        next_track = CarrotButton.NextTrackButton(self, ctx, "⏭️", discord.ButtonStyle.secondary, "next_track")
-        clear_queue = CarrotButton.ClearQueueButton(self, ctx, "🚫", discord.ButtonStyle.secondary, "clear_queue")
-        leave = CarrotButton.LeaveButton(self, ctx, "☠️", discord.ButtonStyle.secondary, "leave")
-
-        # Add buttons to the view
-        view.add_item(prev_track)
-        view.add_item(pp_track)
-        view.add_item(next_track)
-        view.add_item(clear_queue)
-        view.add_item(leave)
+        view = self.player_views[session.is_paused or session.stopped]
         return embed, view
 
 
+    def get_player_message(self, session):
+        if session.player_message is None:
+            session.player_message = PlayerMessage(
+                lambda: self.get_embed_view(session), PLAYER_EDIT_INTERVAL, session.guild.id
+            )
+        return session.player_message
+
     async def edit_player_message(self, ctx: commands.Context):
+        # Coalesced: the edit happens later, rendered from the state at that time
         session = self.check_session(ctx)
+        if session.player_message:
+            session.player_message.update()
 
-        embed, view = self.get_embed_view(ctx, session)
-
-        if session.player_message_id and session.player_channel_id:
-            try:
-                channel = self.bot.get_channel(session.player_channel_id)
-                if channel:
-                    old_msg = await channel.fetch_message(session.player_message_id)
-                    await old_msg.edit(embed=embed, view=view)
-            except (discord.NotFound, discord.Forbidden):
-                pass  # message already gone or no perms
+    def refresh_player_message(self, session):
+        """ Coalesced edit for background work, which outlives its command: the session it
+        holds may be gone by now, and ctx.author may be elsewhere (see check_session). """
+        if session.player_message and not session.closed:
+            session.player_message.update()
 
     async def replace_player_message(
         self,
         ctx: commands.Context
     ):
         session = self.check_session(ctx)
-
-        # Delete old message if it exists
-        if session.player_message_id and session.player_channel_id:
-            try:
-                channel = self.bot.get_channel(session.player_channel_id)
-                if channel:
-                    old_msg = await channel.fetch_message(session.player_message_id)
-                    await old_msg.delete()
-            except (discord.NotFound, discord.Forbidden):
-                pass  # message already gone or no perms
-
-
-        
-        embed, view = self.get_embed_view(ctx, session)
-        msg = await ctx.send(embed=embed, view=view)
-
-        # Store new message info
-        session.player_message_id = msg.id
-        session.player_channel_id = msg.channel.id
-
-
-
+        with METRICS.timer("player_message_replace", ctx.guild.id):
+            await self.get_player_message(session).replace(ctx)
 
 
     async def action_play(self, ctx: commands.Context, query: str, from_button: bool):
@@ -390,7 +768,7 @@ class Music(commands.Cog):
         session = self.check_session(ctx)
 
         if not ctx.voice_client:
-            await voice_channel.connect()
+            await self.connect_voice(ctx.guild, voice_channel)
 
         is_url = self._is_probable_url(query)
         is_spotify = self.is_spotify_link(query)
@@ -408,8 +786,6 @@ class Music(commands.Cog):
                 ctx, query, session, loop, is_url, voice_channel, False
             )
 
-        if tracks_added >= 1:
-            session.end_of_queue = False
         if not from_button:
             await self.replace_player_message(ctx)
         else:
@@ -418,9 +794,7 @@ class Music(commands.Cog):
     async def action_skip(self, ctx: commands.Context, from_button: bool):
         session = self.check_session(ctx)
         if ctx.voice_client:
-            if session.q.has_next():
-                session.q.next()
-                ctx.voice_client.stop()
+            if await self.get_player(session).request(SKIP, ctx):
                 if not from_button:
                     await self.replace_player_message(ctx)
                 else:
@@ -434,28 +808,20 @@ class Music(commands.Cog):
     async def action_previous(self, ctx: commands.Context, from_button: bool):
         session = self.check_session(ctx)
         if ctx.voice_client:
-            if session.q.has_previous():
-                session.q.previous()
-                session.end_of_queue = False
-                ctx.voice_client.stop()
+            if await self.get_player(session).request(PREVIOUS, ctx):
                 if not from_button:
                     await self.replace_player_message(ctx)
                 else:
                     await self.edit_player_message(ctx)
             else:
                 await ctx.send("Não há faixa anterior, brother.")
-            
-
         else:
             await ctx.send("Não estou conectado, brother.")
 
 
     async def action_pause(self, ctx: commands.Context, from_button: bool):
         session = self.check_session(ctx)
-
-        if ctx.voice_client and ctx.voice_client.is_playing():
-            session.is_paused = True
-            ctx.voice_client.pause()
+        if ctx.voice_client and await self.get_player(session).request(PAUSE, ctx):
             if not from_button:
                 await self.replace_player_message(ctx)
             else:
@@ -466,37 +832,17 @@ class Music(commands.Cog):
 
     async def action_resume(self, ctx: commands.Context, from_button: bool):
         session = self.check_session(ctx)
-        if ctx.voice_client and ctx.voice_client.is_paused():
-            ctx.voice_client.resume()
-            session.is_paused = False
-            session.stopped = False
-            if not from_button:
-                await self.replace_player_message(ctx)
-            else:
-                await self.edit_player_message(ctx)
-        elif not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
-            source = discord.FFmpegOpusAudio( 
-                session.q.current_music.url, 
-                executable=FFMPEG_PATH, 
-                before_options=FFMPEG_BEFORE_OPTIONS, 
-                options=FFMPEG_OPTIONS 
-            )
-            session.is_paused = False
-
+        if ctx.voice_client and await self.get_player(session).request(RESUME, ctx):
             if not from_button:
                 await self.replace_player_message(ctx)
             else:
                 await self.edit_player_message(ctx)
-            ctx.voice_client.play(source, after=lambda e: self.prepare_continue_queue(ctx)) 
-
         else:
             await ctx.send("Não há nada para retomar, brother.")
 
     async def action_clear(self, ctx: commands.Context, from_button: bool):
         session = self.check_session(ctx)
-        session.q.clear_queue()
-        if ctx.voice_client:
-            ctx.voice_client.stop()
+        await self.get_player(session).request(CLEAR, ctx)
 
         if not from_button:
             await self.replace_player_message(ctx)
@@ -506,11 +852,14 @@ class Music(commands.Cog):
 
     async def action_leave(self, ctx: commands.Context, from_button: bool):
         if ctx.voice_client:
+            channel = ctx.voice_client.channel
             await ctx.voice_client.disconnect()
+            self.sessions.remove(ctx.guild.id, channel.id)
         else:
             await ctx.send("Não estou conectado, brother.")
 
     async def action_loop(self, ctx: commands.Context, from_button: bool):
+        session = self.check_session(ctx)
         session.q.loop = True
         if not from_button:
             await self.replace_player_message(ctx)
@@ -518,6 +867,7 @@ class Music(commands.Cog):
             await self.edit_player_message(ctx)
 
     async def action_unloop(self, ctx: commands.Context, from_button: bool):
+        session = self.check_session(ctx)
         session.q.loop = False
         if not from_button:
             await self.replace_player_message(ctx)
@@ -602,6 +952,78 @@ class Music(commands.Cog):
         await self.action_clear(ctx, False)
 
 
+    @commands.command(
+        aliases=["q"],
+        help="Show the queue, a page at a time (by default the page of the current song).",
+        brief="Show the queue",
+        usage="[page]"
+    )
+    async def queue(self, ctx, page: int = None):
+        """Show the queue."""
+        session = self.guild_session(ctx.guild)
+        if not session:
+            await ctx.send("Não estou conectado, brother.")
+            return
+        if page is None:
+            page = max(session.q.curr_index, 0) // QUEUE_PAGE_SIZE + 1
+        embed, view = self.render_queue_page(session, page)
+        await ctx.send(embed=embed, view=view)
+
+    @commands.command(
+        help="Shuffle the queue, the current song keeps playing.",
+        brief="Shuffle the queue",
+        usage=""
+    )
+    async def shuffle(self, ctx):
+        """Shuffle the queue."""
+        session = self.check_session(ctx)
+        await self.get_player(session).request(SHUFFLE, ctx)
+        await self.replace_player_message(ctx)
+
+    @commands.command(
+        aliases=["rm"],
+        help="Remove the song at a position of the queue.",
+        brief="Remove a song",
+        usage="<position>"
+    )
+    async def remove(self, ctx, position: int):
+        """Remove a song from the queue."""
+        session = self.check_session(ctx)
+        track = await self.get_player(session).request(REMOVE, ctx, position - 1)
+        if not track:
+            await ctx.send("Essa posição não existe na queue, brother.")
+            return
+        await ctx.send(f"Tirei da queue: {track.title}")
+        await self.edit_player_message(ctx)
+
+    @commands.command(
+        aliases=["mv"],
+        help="Move a song to another position of the queue.",
+        brief="Move a song",
+        usage="<from> <to>"
+    )
+    async def move(self, ctx, src: int, dst: int):
+        """Move a song to another position of the queue."""
+        session = self.check_session(ctx)
+        if not await self.get_player(session).request(MOVE, ctx, src - 1, dst - 1):
+            await ctx.send("Essa posição não existe na queue, brother.")
+            return
+        await self.replace_player_message(ctx)
+
+    @commands.command(
+        aliases=["goto"],
+        help="Jump to the song at a position of the queue.",
+        brief="Jump to a song",
+        usage="<position>"
+    )
+    async def jump(self, ctx, position: int):
+        """Jump to the song at a position of the queue."""
+        session = self.check_session(ctx)
+        if not await self.get_player(session).request(JUMP, ctx, position - 1):
+            await ctx.send("Essa posição não existe na queue, brother.")
+            return
+        await self.replace_player_message(ctx)
+
     # @commands.command(
     #     help="Stop playback and clear the queue.",
     #     brief="Stop music",
@@ -628,6 +1050,171 @@ class Music(commands.Cog):
 
 
 
+    @commands.command(
+        help="Forget the YouTube match of a Spotify track (or of the current track) so it gets searched again.",
+        brief="Forget a bad Spotify match",
+        usage="[spotify track link]"
+    )
+    @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+    async def forget(self, ctx, *, link: str = None):
+        """Forget the YouTube match of a Spotify track."""
+        if link:
+            spotify_id = spotify_track_id(link)
+            if not spotify_id:
+                await ctx.send("Isso não é uma faixa do Spotify, brother.")
+                return
+            removed = MATCH_INDEX.forget(spotify_id)
+        else:
+            current = self.check_session(ctx).q.current_music
+            if not current or not current.video_id:
+                await ctx.send("Não está tocando nada, brother.")
+                return
+            removed = MATCH_INDEX.forget_video(current.video_id)
+        await ctx.send(f"Esqueci {removed} associação(ões) Spotify → YouTube.")
+
+    @commands.command(
+        hidden=True,
+        help="Show or change the FFmpeg encoding profile used for streams that aren't Opus (owner only).",
+        brief="Encoding profile",
+        usage="[" + " | ".join(ENCODING_PROFILES) + "]"
+    )
+    @commands.is_owner()
+    async def encoding(self, ctx, profile: str = None):
+        """Show or change the encoding profile."""
+        if profile:
+            if profile not in ENCODING_PROFILES:
+                await ctx.send("Perfis: " + ", ".join(ENCODING_PROFILES))
+                return
+            self.encoding_profile = profile
+        bitrate, options = ENCODING_PROFILES[self.encoding_profile]
+        await ctx.send(f"Perfil {self.encoding_profile}: {bitrate}k `{options}` (vale para as próximas faixas)")
+
+    @commands.command(
+        hidden=True,
+        help="Show internal counters of the bot (owner only).",
+        brief="Show internal counters",
+        usage=""
+    )
+    @commands.is_owner()
+    async def diag(self, ctx):
+        """Show internal counters of the bot."""
+        report = self.sessions.report()
+        lines = [
+            f"sessions: {report['sessions']} in {report['guilds']} guilds "
+            f"({report['created']} created, {report['removed']} removed), "
+            f"{report['tracks']} tracks queued (~{report['queue_bytes'] // 1024} KB), {report['tasks']} background tasks",
+            f"player messages: {report['message_edits']} edits, {report['edits_skipped']} skipped as unchanged",
+            f"extraction: {self.extractor.name} backend, {self.extractor.workers} workers",
+            "stream cache: {size} urls, {hits} hits, {misses} misses ({hit_rate:.0%})".format(**STREAM_CACHE.stats()),
+            "audio cache: {entries} tracks, {mb:.0f}/{max_mb:.0f} MB, {recording} recording, {hits} hits, {misses} misses ({hit_rate:.0%})".format(
+                mb=AUDIO_CACHE.size / 1024 ** 2, max_mb=AUDIO_CACHE.max_bytes / 1024 ** 2, **AUDIO_CACHE.stats()
+            ),
+            "spotify matches: {size} stored, {hits} hits, {misses} misses".format(**MATCH_INDEX.stats()),
+        ]
+        ffmpeg = self.ffmpeg.stats()
+        lines.append(
+            f"ffmpeg: {ffmpeg['running']}/{ffmpeg['max']} running ({ffmpeg['rss'] // 1024 ** 2} MB), {ffmpeg['waiting']} waiting, "
+            f"{ffmpeg['started']} started, {ffmpeg['rejected']} rejected, {ffmpeg['reaped']} reaped, "
+            f"oldest {ffmpeg['oldest'] / 60:.0f} min, avg lifetime {ffmpeg['avg_lifetime'] / 60:.1f} min, {ffmpeg['cpu']:.0f} s CPU"
+        )
+        lines.append(f"encoding: {self.encoding_profile} profile, opus passthrough {'on' if OPUS_PASSTHROUGH else 'off'}")
+        for mode, (streams, cpu) in ENCODING_STATS.report().items():
+            lines.append(f"  {mode}: {streams} streams, {cpu:.1%} of a core per stream")
+        scheduler = self.scheduler.stats()
+        lines.append(f"extraction scheduler: {scheduler['running']} running, {scheduler['waiting']} waiting, {scheduler['promoted']} promoted")
+        lines.append("merged extractions: {merged} of {started} started, {in_flight} in flight".format(**self.in_flight.stats()))
+        if self.watchdog:
+            lag, _ = METRICS.snapshot()
+            lag = lag.get("loop_lag")
+            lines.append(
+                f"event loop: lag p50 {lag.quantile(0.5) * 1000 if lag else 0:.0f} ms p99 {lag.quantile(0.99) * 1000 if lag else 0:.0f} ms, "
+                f"blocked {self.watchdog.blocked} times over {self.watchdog.threshold:.2f}s, worst {self.watchdog.worst:.2f}s"
+            )
+            for report in list(self.watchdog.reports)[-3:]:
+                lines.append(f"  {report.lag:.2f}s in {report.task}")
+        for guild_id, stats in scheduler["guilds"].items():
+            lines.append(
+                f"  guild {guild_id}: {stats['waiting']} waiting, {stats['running']} running, "
+                f"wait avg {stats['avg_wait']:.2f}s max {stats['max_wait']:.2f}s"
+            )
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    def _stats_lines(self, title, guild_id):
+        histograms, counters = METRICS.snapshot(guild_id)
+        lines = [title]
+        if not histograms and not counters:
+            return lines + ["  nada medido ainda"]
+        lines.append(f"  {'stage':<28}{'n':>7}{'p50':>9}{'p99':>9}{'max':>9}")
+        for stage, histogram in sorted(histograms.items()):
+            lines.append(
+                f"  {stage:<28}{histogram.count:>7}{histogram.quantile(0.5):>8.2f}s"
+                f"{histogram.quantile(0.99):>8.2f}s{histogram.max:>8.2f}s"
+            )
+        for name, n in sorted(counters.items()):
+            lines.append(f"  {name}: {n}")
+        return lines
+
+    @commands.command(
+        hidden=True,
+        help="Show how long each stage of playback takes, globally and in this guild (owner only).",
+        brief="Show latency metrics",
+        usage=""
+    )
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """Show the latency metrics."""
+        lines = self._stats_lines("global:", None)
+        if ctx.guild:
+            lines += self._stats_lines("this guild:", ctx.guild.id)
+        if self.metrics_server:
+            lines.append(f"prometheus: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        await ctx.send("```\n" + "\n".join(lines)[:1900] + "\n```")
+
+    @commands.command(
+        hidden=True,
+        help="Sample the stacks of every thread for a few seconds and post the hottest "
+             "functions, with a collapsed-stack file for flamegraphs (owner only).",
+        brief="Sampling profiler",
+        usage="[seconds] [top]"
+    )
+    @commands.is_owner()
+    async def profile(self, ctx, seconds: float = 10, top: int = 15):
+        """Profile the bot."""
+        if self.profiler:
+            await ctx.send("Já tem um profile rodando, brother.")
+            return
+        seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+        top = min(max(top, 1), 25)
+        profiler = self.profiler = SamplingProfiler(PROFILE_INTERVAL)
+        await ctx.send(f"Perfilando por {seconds:.0f}s...")
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+            self.profiler = None
+
+        path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.txt"))
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, profiler.write_collapsed, path)
+        except OSError as e:
+            print("profile write error:", e)
+            path = None
+        hottest, bot_paths = profiler.hottest(top)
+        lines = [
+            f"{profiler.ticks} ticks in {profiler.duration:.1f}s, {profiler.samples} busy thread samples "
+            f"({profiler.idle} idle skipped)",
+            "self (where the CPU goes):",
+        ]
+        lines += [f"  {share:6.1%}  {label}" for label, share in hottest]
+        lines.append("total, bot code (what leads there):")
+        lines += [f"  {share:6.1%}  {label}" for label, share in bot_paths]
+        text = "```\n" + "\n".join(lines)[:1900] + "\n```"
+        if path:
+            await ctx.send(text, file=discord.File(path))
+        else:
+            await ctx.send(text)
+
     @commands.command(
         aliases=["show_player", "show", "player", ],
         help="Bring up info about the current session.",
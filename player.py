@@ -0,0 +1,431 @@
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+from ffmpeg_governor import FFmpegSaturated
+from metrics import METRICS
+
+# Discord sends one 20 ms Opus frame per read()
+FRAME_SECONDS = 0.02
+
+
+class TrackSource(discord.AudioSource):
+    """Opus source of one queued track, wrapping its FFmpegOpusAudio.
+
+    The first frames can be read ahead of time with prebuffer(), so a source
+    prepared while the previous track is still playing starts without waiting
+    for FFmpeg to connect and buffer. notify_near_end() registers a callback
+    that runs once, on the audio thread, when `lead` seconds of the track are left.
+    With a `recorder` (audio_cache.CacheRecorder) every packet read is also written
+    to the audio cache. `process` is the ffmpeg_governor.FFmpegProcess behind
+    `inner`, closed (measured, killed and its slot freed) by cleanup(); the time it
+    takes to produce its first packet goes to the ffmpeg_first_packet metric."""
+
+    def __init__(self, inner, link, duration=None, log=None, recorder=None, process=None):
+        self.inner = inner
+        self.link = link
+        self.duration = duration
+        # stderr of the FFmpeg process, see utilities.FFmpegLog
+        self.log = log
+        self.recorder = recorder
+        self.process = process
+        if process:
+            process.attach(self)
+        self.buffer = deque()
+        self.frames = 0
+        # inner produced a packet
+        self.started = False
+        self.near_end_frame = None
+        self.near_end_callback = None
+
+    @property
+    def elapsed(self):
+        return self.frames * FRAME_SECONDS
+
+    def prebuffer(self, frames):
+        """Blocking, run it in a thread before the source starts playing."""
+        for _ in range(frames):
+            packet = self._read_inner()
+            if not packet:
+                break
+            self.buffer.append(packet)
+
+    def notify_near_end(self, lead, callback):
+        if not self.duration or self.duration <= lead:
+            return
+        self.near_end_frame = int((self.duration - lead) / FRAME_SECONDS)
+        self.near_end_callback = callback
+
+    def _read_inner(self):
+        packet = self.inner.read()
+        if packet and not self.started:
+            self.started = True
+            if self.process:
+                METRICS.observe("ffmpeg_first_packet", self.process.age(), self.process.guild_id)
+        if self.recorder:
+            if packet:
+                self.recorder.write(packet)
+            else:
+                # end of the stream, complete unless the server refused it
+                if self.log and self.log.forbidden:
+                    self.recorder.abort()
+                else:
+                    self.recorder.finish()
+                self.recorder = None
+        return packet
+
+    def read(self):
+        packet = self.buffer.popleft() if self.buffer else self._read_inner()
+        self.frames += 1
+        if self.near_end_callback and self.frames >= self.near_end_frame:
+            callback, self.near_end_callback = self.near_end_callback, None
+            callback()
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.buffer.clear()
+        if self.recorder:
+            # stopped before the end (skip, clear, leave)
+            self.recorder.abort()
+            self.recorder = None
+        if self.process:
+            self.process.close(self.elapsed)
+        else:
+            self.inner.cleanup()
+
+
+# Player events
+TRACK_ENDED = "track_ended"
+PLAY = "play"
+SKIP = "skip"
+PREVIOUS = "previous"
+PAUSE = "pause"
+RESUME = "resume"
+CLEAR = "clear"
+JUMP = "jump"
+REMOVE = "remove"
+MOVE = "move"
+SHUFFLE = "shuffle"
+
+
+class Player:
+    """Playback state machine of one session.
+
+    Every change to the queue or to what the voice client plays happens in
+    run(), one event at a time, on the event loop. Commands post an event and
+    await its result; the audio thread only posts TRACK_ENDED through
+    post_threadsafe() when a source finishes, it never blocks or touches the queue."""
+
+    def __init__(self, cog, session, loop):
+        self.cog = cog
+        self.session = session
+        self.loop = loop
+        self.events = asyncio.Queue()
+        # source handed to the voice client, a TRACK_ENDED for any other one is stale
+        self.source = None
+        # the last track finished and nothing came after it
+        self.exhausted = False
+        # context of the last command, where messages about playback go
+        self.ctx = None
+        # future of the event run() is handling, close() resolves it if that gets cancelled
+        self.current = None
+        self.task = loop.create_task(self.run(), name=f"player in guild {session.guild.id}")
+
+    def post(self, event, ctx=None, *args):
+        future = self.loop.create_future()
+        self.events.put_nowait((event, ctx, args, future))
+        return future
+
+    def post_threadsafe(self, event, *args):
+        try:
+            self.loop.call_soon_threadsafe(self.post, event, None, *args)
+        except RuntimeError:
+            # the loop is closed, the bot is shutting down
+            pass
+
+    async def request(self, event, ctx=None, *args):
+        return await self.post(event, ctx, *args)
+
+    async def run(self):
+        while True:
+            event, ctx, args, future = await self.events.get()
+            self.current = future
+            # what the loop watchdog reports if handling it blocks the loop
+            self.task.set_name(f"player {event} in guild {self.session.guild.id}")
+            if ctx is not None:
+                self.ctx = ctx
+            try:
+                result = await getattr(self, "on_" + event)(*args)
+            except Exception as e:
+                print(f"player {event} error:", e)
+                result = False
+            self.current = None
+            if not future.done():
+                future.set_result(result)
+
+    def close(self):
+        self.task.cancel()
+        pending = [self.current] if self.current else []
+        while not self.events.empty():
+            pending.append(self.events.get_nowait()[3])
+        for future in pending:
+            if not future.done():
+                future.set_result(False)
+        self.current = None
+        self.source = None
+
+    # ---------- helpers ----------
+
+    async def send(self, message):
+        if self.ctx:
+            await self.ctx.send(message)
+
+    async def voice(self):
+        return self.session.guild.voice_client or await self.cog.connect_voice(self.session.guild, self.session.channel)
+
+    async def play_current(self, retry=False):
+        """Start the current track, replacing whatever the voice client is playing.
+        `retry` is a new attempt after its stream url was refused, it gets no other."""
+        self.session.retried_video_id = self.session.q.current_music.video_id if retry else None
+        try:
+            source = await self.cog.create_source(self.loop, self.session)
+        except FFmpegSaturated as e:
+            print("ffmpeg saturated:", e)
+            METRICS.count("ffmpeg_saturated", self.session.guild.id)
+            await self.send("Muita gente ouvindo música agora, tenta de novo daqui a pouco.")
+            return False
+        if not source:
+            await self.send("Erro: Não consegui pegar audio do YouTube.")
+            return False
+        vc = await self.voice()
+        # set before stop(), so the TRACK_ENDED of the replaced source is ignored
+        self.source = source
+        if vc.is_playing() or vc.is_paused():
+            vc.stop()
+        vc.play(source, after=lambda error, source=source: self.post_threadsafe(TRACK_ENDED, source, error))
+        METRICS.count("tracks_started", self.session.guild.id)
+        self.session.is_paused = False
+        self.exhausted = False
+        return True
+
+    def refresh(self):
+        if self.session.player_message:
+            self.session.player_message.update()
+
+    # ---------- events ----------
+
+    async def on_track_ended(self, source, error):
+        if source is not self.source:
+            return False
+        self.source = None
+        if error:
+            print("player error:", error)
+
+        q = self.session.q
+        current = q.current_music
+        if source.log and source.log.forbidden and current and self.session.retried_video_id != current.video_id:
+            # The stream url was refused (expired or revoked): forget it and play the same track again
+            self.cog.forget_stream(current.video_id)
+            return await self.play_current(retry=True)
+
+        if not q.has_next():
+            self.exhausted = True
+            await self.send("Acabou a queue, brother.")
+            self.refresh()
+            return False
+        q.next()
+        playing = await self.play_current()
+        self.refresh()
+        return playing
+
+    async def on_play(self):
+        """Start playing if the voice client is idle (first track, or tracks added after the queue ran out)."""
+        vc = await self.voice()
+        if vc.is_playing() or vc.is_paused():
+            return True
+        q = self.session.q
+        if q.curr_index == -1:
+            q.set_first_as_current()
+        elif self.exhausted:
+            if not q.has_next():
+                return False
+            q.next()
+        return await self.play_current()
+
+    async def on_skip(self):
+        if not self.session.q.has_next():
+            return False
+        self.session.q.next()
+        self.session.discard_next_source()
+        return await self.play_current()
+
+    async def on_previous(self):
+        if not self.session.q.has_previous():
+            return False
+        self.session.q.previous()
+        self.session.discard_next_source()
+        return await self.play_current()
+
+    async def on_pause(self):
+        vc = self.session.guild.voice_client
+        if not vc or not vc.is_playing():
+            return False
+        vc.pause()
+        self.session.is_paused = True
+        return True
+
+    async def on_resume(self):
+        vc = self.session.guild.voice_client
+        if vc and vc.is_paused():
+            vc.resume()
+            self.session.is_paused = False
+            self.session.stopped = False
+            return True
+        if vc and not vc.is_playing() and self.session.q.current_music:
+            return await self.play_current()
+        return False
+
+    async def on_clear(self):
+        self.session.cancel_tasks()
+        self.session.cancel_prefetches()
+        self.session.discard_next_source()
+        self.session.q.clear_queue()
+        self.source = None
+        self.exhausted = False
+        vc = self.session.guild.voice_client
+        if vc:
+            vc.stop()
+        return True
+
+
+    async def on_jump(self, index):
+        if not self.session.q.jump(index):
+            return False
+        self.session.discard_next_source()
+        return await self.play_current()
+
+    async def on_remove(self, index):
+        q = self.session.q
+        was_current = index == q.curr_index
+        track = q.remove(index)
+        if track is None or not was_current:
+            return track
+        if index < len(q) or q.loop and len(q):
+            # the track after the removed one became current (the first one, when it looped)
+            await self.play_current()
+        else:
+            # it was the last one, like if it had ended
+            self.source = None
+            self.exhausted = True
+            vc = self.session.guild.voice_client
+            if vc:
+                vc.stop()
+        return track
+
+    async def on_move(self, src, dst):
+        return self.session.q.move(src, dst)
+
+    async def on_shuffle(self):
+        self.session.q.shuffle()
+        return True
+
+
+def unbind_view(message):
+    """discord.py files the view of every message sent or edited with one under that
+    message's id, and only forgets it when the view stops, which the persistent player
+    views never do. Their bot-wide registration (bot.add_view) already routes presses on
+    any message, so drop the per message entries right away."""
+    state = message._state
+    state.prevent_view_updates_for(message.id)
+    state._view_store._views.pop(message.id, None)
+
+
+class PlayerMessage:
+    """The player embed of one session.
+
+    Keeps the sent discord.Message, so edits and deletes don't fetch it first.
+    update() only marks the message stale: a single task renders the latest
+    state and edits at most once every `interval` seconds, however many updates
+    arrive meanwhile, and skips the edit when nothing visible changed."""
+
+    def __init__(self, render, interval, guild_id=None):
+        # () -> (embed, view)
+        self.render = render
+        self.interval = interval
+        self.guild_id = guild_id
+        self.message = None
+        self.stale = False
+        self.rendered = None
+        self.last_edit = 0.0
+        self.task = None
+        self.edits = 0
+        self.skipped = 0
+
+    @staticmethod
+    def _key(embed, view):
+        return embed.to_dict(), [item.to_component_dict() for item in view.children]
+
+    def update(self):
+        self.stale = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        while self.stale and self.message:
+            delay = self.last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.stale = False
+            embed, view = self.render()
+            key = self._key(embed, view)
+            if key == self.rendered:
+                self.skipped += 1
+                continue
+            try:
+                with METRICS.timer("player_message_edit", self.guild_id):
+                    await self.message.edit(embed=embed, view=view)
+            except discord.NotFound:
+                self.message = None
+                return
+            except discord.Forbidden as e:
+                # no point in retrying, the next state change tries again
+                print("player message edit error:", e)
+            except (discord.HTTPException, asyncio.TimeoutError) as e:
+                # rate limited, Discord error or timeout: retry after the interval
+                print("player message edit error:", e)
+                self.stale = True
+            else:
+                unbind_view(self.message)
+                self.rendered = key
+                self.edits += 1
+            self.last_edit = time.monotonic()
+
+    async def replace(self, ctx):
+        """Delete the current message and send a new one at the bottom of the channel."""
+        self.stale = False
+        self.cancel()
+        old, self.message = self.message, None
+        if old:
+            try:
+                await old.delete()
+            except (discord.NotFound, discord.Forbidden):
+                pass  # message already gone or no perms
+
+        embed, view = self.render()
+        self.message = await ctx.send(embed=embed, view=view)
+        unbind_view(self.message)
+        self.rendered = self._key(embed, view)
+        self.last_edit = time.monotonic()
+        if self.stale:
+            # state changed while the message was being sent
+            self.update()
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# The bot's own modules live next to this one
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (file suffix, function) of the Python frames threads sit in while they wait for
+# something: a thread whose innermost frame is one of these isn't using the CPU
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("concurrent/futures/thread.py", "_worker"),
+    ("discord/player.py", "_do_run"),
+    ("discord/gateway.py", "run"),
+}
+
+
+def module_name(filename):
+    """Short name of a source file: relative to the bot or to site-packages, else its basename."""
+    path = os.path.normpath(filename)
+    if path.startswith(BOT_DIR + os.sep):
+        path = os.path.relpath(path, BOT_DIR)
+    elif "-packages" + os.sep in path:
+        path = path.split("-packages" + os.sep, 1)[1]
+    else:
+        path = os.path.basename(path)
+    return path.replace(os.sep, "/")
+
+
+def is_bot_code(code):
+    path = os.path.normpath(code.co_filename)
+    return path.startswith(BOT_DIR + os.sep) and "-packages" not in path
+
+
+def thread_group(name):
+    # threads of a pool ("asyncio_3", "yt-dlp_0", "Thread-7 (run)") are one group
+    return re.sub(r"[_-]?\d+(?= \(|$)", "", name) or name
+
+
+class SamplingProfiler:
+    """Samples the Python stack of every thread of the process (event loop, executors,
+    extraction threads, audio threads) every `interval` seconds, from a thread of its
+    own. Threads waiting on something (see IDLE_FRAMES) aren't counted, so the samples
+    show where the CPU goes. Stacks are kept as code objects and counted, names are
+    only resolved when reporting."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        # (thread group, code objects from the outermost frame in) -> samples
+        self.stacks = Counter()
+        self.ticks = 0
+        # thread stacks counted, and skipped as idle
+        self.samples = 0
+        self.idle = 0
+        self.started_at = None
+        self.duration = 0.0
+        self.stopping = threading.Event()
+        self.thread = None
+        self._idle_codes = {}
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        self.duration = time.monotonic() - self.started_at
+
+    def _is_idle(self, code):
+        idle = self._idle_codes.get(code)
+        if idle is None:
+            path = code.co_filename.replace(os.sep, "/")
+            idle = self._idle_codes[code] = any(
+                path.endswith(suffix) and code.co_name == name for suffix, name in IDLE_FRAMES
+            )
+        return idle
+
+    def _sample(self, names):
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if self._is_idle(frame.f_code):
+                self.idle += 1
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+            self.stacks[names.get(ident, "?"), tuple(codes)] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.ticks += 1
+            names = {thread.ident: thread_group(thread.name) for thread in threading.enumerate()}
+            self._sample(names)
+
+    @staticmethod
+    def _label(code):
+        return f"{module_name(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+    def collapsed(self):
+        """The samples as collapsed stacks ("thread;outer;...;inner count" per line), the
+        input of flamegraph.pl, speedscope and the like."""
+        lines = Counter()
+        for (thread, codes), n in self.stacks.items():
+            lines[";".join([thread] + [self._label(code) for code in codes])] += n
+        return [f"{stack} {n}" for stack, n in sorted(lines.items())]
+
+    def write_collapsed(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n".join(self.collapsed()) + "\n")
+
+    def hottest(self, n):
+        """Top n functions by self samples (where the CPU is spent) and top n of the bot's
+        own functions by total samples (which of its code paths lead there), as
+        [(label, share of busy samples)] lists."""
+        own = Counter()
+        total = Counter()
+        for (_, codes), count in self.stacks.items():
+            own[codes[-1]] += count
+            for code in set(codes):
+                if is_bot_code(code):
+                    total[code] += count
+        busy = self.samples or 1
+        return (
+            [(self._label(code), count / busy) for code, count in own.most_common(n)],
+            [(self._label(code), count / busy) for code, count in total.most_common(n)],
+        )
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import re
+import time
+
+import aiohttp
+
+API_URL = "https://api.spotify.com/v1"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+SPOTIFY_LINK_RE = re.compile(r"(track|album|playlist)[/:]([A-Za-z0-9]{22})")
+
+# Only what match_spotify_track needs, keeps playlist pages small
+PLAYLIST_FIELDS = "next,items(track(type,id,name,duration_ms,external_ids,artists(name)))"
+
+
+class SpotifyError(Exception):
+    pass
+
+
+def parse_spotify_link(link):
+    """Return (kind, id) of a Spotify track/album/playlist link or uri, or (None, None)."""
+    match = SPOTIFY_LINK_RE.search(link or "")
+    return match.groups() if match else (None, None)
+
+
+class AsyncSpotify:
+    """Non-blocking client for the few Spotify Web API calls the bot makes.
+
+    Uses the client-credentials flow. The token is kept in the same `.cache` file
+    (and format) spotipy uses, so restarts reuse it until it expires. All requests
+    share one pooled aiohttp session."""
+
+    def __init__(self, client_id, client_secret, cache_path=".cache"):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cache_path = cache_path
+        self.token = self._load_token()
+        self.token_lock = asyncio.Lock()
+        self.http = None
+
+    def _load_token(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_token(self):
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(self.token, f)
+        except OSError as e:
+            print("spotify token cache error:", e)
+
+    def _token_valid(self):
+        return self.token and self.token.get("expires_at", 0) - 60 > time.time()
+
+    def _session(self):
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=20),
+            )
+        return self.http
+
+    async def _access_token(self, refresh=False):
+        async with self.token_lock:
+            if refresh or not self._token_valid():
+                async with self._session().post(
+                    TOKEN_URL,
+                    data={"grant_type": "client_credentials"},
+                    auth=aiohttp.BasicAuth(self.client_id or "", self.client_secret or ""),
+                ) as response:
+                    if response.status != 200:
+                        raise SpotifyError(f"token request failed with HTTP {response.status}")
+                    token = await response.json()
+                token["expires_at"] = int(time.time()) + token["expires_in"]
+                self.token = token
+                self._save_token()
+            return self.token["access_token"]
+
+    async def _get(self, url, params=None):
+        if url.startswith("/"):
+            url = API_URL + url
+        try:
+            return await self._get_json(url, params)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise SpotifyError(f"GET {url} failed: {e!r}") from e
+
+    async def _get_json(self, url, params):
+        refreshed = False
+        while True:
+            headers = {"Authorization": f"Bearer {await self._access_token()}"}
+            async with self._session().get(url, params=params, headers=headers) as response:
+                if response.status == 200:
+                    return await response.json()
+                if response.status == 401 and not refreshed:
+                    refreshed = True
+                    await self._access_token(refresh=True)
+                    continue
+                if response.status == 429:
+                    await asyncio.sleep(int(response.headers.get("Retry-After", 1)))
+                    continue
+                raise SpotifyError(f"GET {url} failed with HTTP {response.status}")
+
+    async def _paginate(self, url, params):
+        """Yield the items of every page, the next page being fetched while the current one is consumed."""
+        next_page = asyncio.ensure_future(self._get(url, params))
+        try:
+            while next_page:
+                page = await next_page
+                next_page = asyncio.ensure_future(self._get(page["next"])) if page.get("next") else None
+                for item in page.get("items") or []:
+                    yield item
+        finally:
+            if next_page:
+                next_page.cancel()
+
+    async def track(self, track_id):
+        return await self._get(f"/tracks/{track_id}")
+
+    async def playlist_tracks(self, playlist_id):
+        async for item in self._paginate(f"/playlists/{playlist_id}/tracks", {"limit": 100, "fields": PLAYLIST_FIELDS}):
+            track = item.get("track")
+            if track and track.get("type", "track") == "track" and track.get("id"):
+                yield track
+
+    async def album_tracks(self, album_id):
+        async for track in self._paginate(f"/albums/{album_id}/tracks", {"limit": 50}):
+            yield track
+
+    async def tracks(self, link):
+        """Stream every track behind a track, album or playlist link."""
+        kind, spotify_id = parse_spotify_link(link)
+        if kind == "playlist":
+            async for track in self.playlist_tracks(spotify_id):
+                yield track
+        elif kind == "album":
+            async for track in self.album_tracks(spotify_id):
+                yield track
+        elif kind == "track":
+            yield await self.track(spotify_id)
+        else:
+            raise SpotifyError(f"not a Spotify track, album or playlist: {link}")
+
+    async def close(self):
+        if self.http:
+            await self.http.close()
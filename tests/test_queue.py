@@ -0,0 +1,135 @@
+import random
+
+import pytest
+
+from utilities import Queue
+
+
+def make_queue(n, current):
+    q = Queue()
+    for i in range(n):
+        q.enqueue(f"track {i}", f"video{i:06d}", None, f"https://www.youtube.com/watch?v=video{i:06d}")
+    q.jump(current)
+    return q
+
+
+def titles(q):
+    return [track.title for track in q]
+
+
+def test_remove_before_current():
+    q = make_queue(5, 2)
+    assert q.remove(0).title == "track 0"
+    assert q.curr_index == 1
+    assert q.current_music.title == "track 2"
+
+
+def test_remove_after_current():
+    q = make_queue(5, 2)
+    assert q.remove(4).title == "track 4"
+    assert q.curr_index == 2
+    assert q.current_music.title == "track 2"
+
+
+def test_remove_current_makes_the_next_one_current():
+    q = make_queue(5, 2)
+    assert q.remove(2).title == "track 2"
+    assert q.curr_index == 2
+    assert q.current_music.title == "track 3"
+
+
+def test_remove_current_at_the_end_makes_the_previous_one_current():
+    q = make_queue(5, 4)
+    q.remove(4)
+    assert q.curr_index == 3
+    assert q.current_music.title == "track 3"
+
+
+def test_remove_current_at_the_end_in_loop_mode_wraps_to_the_first():
+    q = make_queue(5, 4)
+    q.loop = True
+    q.remove(4)
+    assert q.curr_index == 0
+    assert q.current_music.title == "track 0"
+
+
+def test_remove_the_only_track_in_loop_mode():
+    q = make_queue(1, 0)
+    q.loop = True
+    q.remove(0)
+    assert q.curr_index == -1
+    assert q.current_music is None
+
+
+def test_remove_the_last_track():
+    q = make_queue(1, 0)
+    q.remove(0)
+    assert len(q) == 0
+    assert q.curr_index == -1
+    assert q.current_music is None
+
+
+def test_remove_out_of_range():
+    q = make_queue(3, 1)
+    version = q.version
+    assert q.remove(3) is None
+    assert q.remove(-1) is None
+    assert q.curr_index == 1
+    assert q.version == version
+
+
+@pytest.mark.parametrize("src, dst, order, current", [
+    # from before the current track to after it
+    (0, 3, [1, 2, 3, 0, 4], 1),
+    # from after the current track to before it
+    (4, 1, [0, 4, 1, 2, 3], 3),
+    # onto the current track's position, from either side
+    (0, 2, [1, 2, 0, 3, 4], 1),
+    (4, 2, [0, 1, 4, 2, 3], 3),
+    # entirely on one side of it
+    (3, 4, [0, 1, 2, 4, 3], 2),
+    (0, 1, [1, 0, 2, 3, 4], 2),
+    # the current track itself
+    (2, 0, [2, 0, 1, 3, 4], 0),
+    (2, 4, [0, 1, 3, 4, 2], 4),
+])
+def test_move_keeps_the_current_track(src, dst, order, current):
+    q = make_queue(5, 2)
+    assert q.move(src, dst)
+    assert titles(q) == [f"track {i}" for i in order]
+    assert q.curr_index == current
+    assert q.current_music.title == "track 2"
+
+
+def test_move_out_of_range():
+    q = make_queue(3, 1)
+    assert not q.move(0, 3)
+    assert not q.move(3, 0)
+    assert titles(q) == ["track 0", "track 1", "track 2"]
+    assert q.curr_index == 1
+
+
+def test_jump():
+    q = make_queue(5, 0)
+    assert q.jump(3)
+    assert q.current_music.title == "track 3"
+    assert not q.jump(5)
+    assert not q.jump(-1)
+    assert q.curr_index == 3
+
+
+def test_shuffle_keeps_the_current_track_first():
+    random.seed(1)
+    q = make_queue(20, 7)
+    q.shuffle()
+    assert q.curr_index == 0
+    assert q.current_music.title == "track 7"
+    assert sorted(titles(q)) == sorted(f"track {i}" for i in range(20))
+    assert titles(q)[1:] != [f"track {i}" for i in range(20) if i != 7]
+
+
+def test_shuffle_without_a_current_track():
+    q = Queue()
+    q.shuffle()
+    assert len(q) == 0
+    assert q.curr_index == -1
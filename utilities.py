@@ -1,42 +1,110 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import random
+import re
+import sys
+import time
+
+YOUTUBE_VIDEO_ID_RE = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/live/)([\w-]{11})")
+STREAM_EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def youtube_video_id(url):
+    """Return the video id of a single-video YouTube url, or None (playlists included)."""
+    if not url or "list=" in url:
+        return None
+    match = YOUTUBE_VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+def stream_url_expiry(url):
+    """Return the unix time a googlevideo stream url expires at, or None if it doesn't say."""
+    match = STREAM_EXPIRE_RE.search(url or "")
+    return int(match.group(1)) if match else None
+
+YOUTUBE_WATCH_URL = "https://www.youtube.com/watch?v={}"
+YOUTUBE_THUMB_URL = "https://i.ytimg.com/vi/{}/hqdefault.jpg"
+
+
+class Track:
+    """One queued track. Shared by every queue and slotted, so a track costs one small
+    object plus its strings. The link and thumbnail of a YouTube video are derived
+    from its id instead of being stored; other sites' tracks (SoundCloud, Bandcamp...)
+    have an id too, but keep both."""
+
+    __slots__ = ("title", "video_id", "_thumb", "_link", "duration")
+
+    def __init__(self, title, video_id, thumb, link, duration=None):
+        self.title = title
+        self.video_id = video_id
+        self._link = None if video_id and link == YOUTUBE_WATCH_URL.format(video_id) else link
+        self._thumb = None if self._link is None else thumb
+        self.duration = duration
+
+    @property
+    def link(self):
+        return self._link or YOUTUBE_WATCH_URL.format(self.video_id)
+
+    @property
+    def thumb(self):
+        if self._link is None:
+            return YOUTUBE_THUMB_URL.format(self.video_id)
+        return self._thumb
+
+    def __iter__(self):
+        # unpacks like the (title, video_id, thumb, link, duration) tuples it's built from
+        return iter((self.title, self.video_id, self.thumb, self.link, self.duration))
+
+    def __repr__(self):
+        return f"Track({self.title!r}, {self.video_id!r})"
+
 
 class Queue:
+    """Tracks of a session and the position of the one playing.
+
+    Backed by a list: append, indexing and jumps are O(1), remove and move shift
+    the pointers after the index (a memmove, microseconds for 10k tracks).
+    curr_index always follows the current track through removes, moves and shuffles.
+    `version` changes whenever the tracks or the current one change."""
+
     def __init__(self):
-        self.music = namedtuple('music', ('title', 'url', 'thumb', 'link'))
         self.queue = []
-        self.current_music = None
         self.curr_index = -1
         self.loop = False
+        self.version = 0
+
+    @property
+    def current_music(self):
+        return self.queue[self.curr_index] if self.curr_index >= 0 else None
 
-    def enqueue(self, title, url, thumb, link):
-        self.queue.append(self.music(title, url, thumb, link))
+    def enqueue(self, title, video_id, thumb, link, duration=None):
+        self.queue.append(Track(title, video_id, thumb, link, duration))
+        self.version += 1
         if self.curr_index == -1:
             self.curr_index = 0
-            self.current_music = self.queue[self.curr_index]
+
+    def enqueue_many(self, tracks):
+        """Append (title, video_id, thumb, link, duration) tuples in one go, returns how many."""
+        before = len(self.queue)
+        self.queue.extend(track if isinstance(track, Track) else Track(*track) for track in tracks)
+        self.version += 1
+        if self.curr_index == -1 and self.queue:
+            self.curr_index = 0
+        return len(self.queue) - before
 
     def set_first_as_current(self):
         if len(self.queue) > 0:
             self.curr_index = 0
-            self.current_music = self.queue[self.curr_index]
+            self.version += 1
 
     def next(self):
         if self.curr_index == -1 and len(self.queue) == 0:
             return False
         
-        if self.curr_index == len(self.queue) - 1:
+        if self.curr_index == len(self.queue) - 1 and not self.loop:
             return False
 
-        
-        
-        if self.loop:
-            self.curr_index = (self.curr_index + 1) % len(self.queue)
-        else:
-            self.curr_index += 1
-        # else:
-        #     del self.queue[self.curr_index]
-
-        self.current_music = self.queue[self.curr_index]
+        self.curr_index = (self.curr_index + 1) % len(self.queue)
+        self.version += 1
         return True
     
     def has_next(self):
@@ -46,10 +114,15 @@ class Queue:
         if self.loop:
             return len(self.queue) > 0
 
-        if self.curr_index < len(self.queue)-1:
-            return True
+        return self.curr_index < len(self.queue) - 1
 
-        return False
+    def upcoming(self, count):
+        """Return up to `count` tracks that will play after the current one."""
+        start = self.curr_index + 1
+        tracks = self.queue[start:start + count]
+        if self.loop and len(tracks) < count:
+            tracks += self.queue[:min(count - len(tracks), max(self.curr_index, 0))]
+        return tracks
 
     def has_previous(self):
         if self.curr_index == -1:
@@ -65,39 +138,70 @@ class Queue:
             return False
 
         if self.loop:
-            self.curr_index = self.curr_index - 1
-            if self.curr_index < 0:
-                self.curr_index += len(queue)
-            self.current_music = self.queue[self.curr_index]
+            self.curr_index = (self.curr_index - 1) % len(self.queue)
+            self.version += 1
             return True
 
         elif self.curr_index > 0:
             self.curr_index = self.curr_index - 1
-            self.current_music = self.queue[self.curr_index]
+            self.version += 1
             return True
 
         return False
 
+    def jump(self, index):
+        """Make the track at `index` the current one."""
+        if not 0 <= index < len(self.queue):
+            return False
+        self.curr_index = index
+        self.version += 1
+        return True
+
+    def remove(self, index):
+        """Remove and return the track at `index`. If it was the current one, the track
+        after it becomes current: at the end of the queue that's the first one in loop
+        mode, else the one before."""
+        if not 0 <= index < len(self.queue):
+            return None
+        track = self.queue.pop(index)
+        self.version += 1
+        if index < self.curr_index:
+            self.curr_index -= 1
+        elif self.curr_index >= len(self.queue):
+            self.curr_index = 0 if self.loop and self.queue else len(self.queue) - 1
+        return track
+
+    def move(self, src, dst):
+        """Move the track at `src` to `dst`, the current track stays current."""
+        if not (0 <= src < len(self.queue) and 0 <= dst < len(self.queue)):
+            return False
+        self.queue.insert(dst, self.queue.pop(src))
+        self.version += 1
+        if self.curr_index == src:
+            self.curr_index = dst
+        elif src < self.curr_index <= dst:
+            self.curr_index -= 1
+        elif dst <= self.curr_index < src:
+            self.curr_index += 1
+        return True
 
     def clear_queue(self):
         self.queue = []
         self.curr_index = -1
-        self.current_music = None
         self.loop = False
+        self.version += 1
 
     def shuffle(self):
-        if self.queue != [] or self.curr_index != -1 or self.current_music != None:
-            print("Cannot do ordinary shuffle while playing music")
-        random.shuffle(self.queue)
-
-    def shuffle_while_playing(self):
-        if self.queue == [] and self.curr_index == -1 and self.current_music == None:
-            shuffle()
+        """Shuffle the queue. While a track is current it moves to the front and
+        everything else is shuffled after it, so it keeps playing."""
+        current = self.current_music
+        self.version += 1
+        if current is None:
+            random.shuffle(self.queue)
             return
-        
-        del queue[self.curr_index]
-        random.shuffle(queue)
-        self.queue.insert(self.current_music)
+        del self.queue[self.curr_index]
+        random.shuffle(self.queue)
+        self.queue.insert(0, current)
         self.curr_index = 0
 
     def __len__(self):
@@ -107,13 +211,98 @@ class Queue:
         """Called when accessing an item: my_object[key]"""
         return self.queue[key]
 
-    def __setitem__(self, key, value):
-        """Called when setting an item: my_object[key] = value"""
-        self.queue[key] = value
+    def memory_usage(self):
+        """Approximate bytes held by the queue and its track records."""
+        total = sys.getsizeof(self.queue)
+        for track in self.queue:
+            total += sys.getsizeof(track)
+            for field in (track.title, track.video_id, track._thumb, track._link, track.duration):
+                if field is not None:
+                    total += sys.getsizeof(field)
+        return total
 
-    def __delitem__(self, key):
-        """Called when deleting an item: del my_object[key]"""
-        del self.queue[key]
+
+StreamEntry = namedtuple('StreamEntry', ('url', 'title', 'thumb', 'duration', 'expires_at', 'acodec', 'asr'), defaults=(None, None))
+
+
+class StreamCache:
+    """Process-wide LRU cache of resolved audio stream urls, keyed by video id.
+
+    Entries live until the `expire=` timestamp of their url (minus a safety margin,
+    so a track never starts on a url about to die) or `default_ttl` seconds if the
+    url doesn't carry one. Only used from the event loop thread."""
+
+    def __init__(self, max_entries=2048, default_ttl=3600, safety_margin=600):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.safety_margin = safety_margin
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, video_id):
+        entry = self.entries.get(video_id) if video_id else None
+        if entry and entry.expires_at <= time.time():
+            del self.entries[video_id]
+            entry = None
+        return entry
+
+    def get(self, video_id):
+        entry = self._lookup(video_id)
+        if entry:
+            self.hits += 1
+            self.entries.move_to_end(video_id)
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, video_id, url, title=None, thumb=None, duration=None, acodec=None, asr=None):
+        """Store a stream url and return its StreamEntry (returned but not stored without a video id)."""
+        if not url:
+            return None
+        expires_at = stream_url_expiry(url)
+        if expires_at is None:
+            expires_at = time.time() + self.default_ttl + self.safety_margin
+        entry = StreamEntry(url, title, thumb, duration, expires_at - self.safety_margin, acodec, asr)
+        if not video_id:
+            return entry
+        self.entries[video_id] = entry
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, video_id):
+        self.entries.pop(video_id, None)
+
+    def __contains__(self, video_id):
+        """Membership test that doesn't count as a hit or a miss."""
+        return self._lookup(video_id) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class FFmpegLog:
+    """File-like sink for an FFmpeg process' stderr. Remembers whether the server
+    refused the stream url (HTTP 403), which means it has to be resolved again."""
+
+    def __init__(self):
+        self.forbidden = False
+
+    def write(self, data):
+        if b"403" in data:
+            self.forbidden = True
+        return len(data)
 
 
 class Session:
@@ -124,7 +313,128 @@ class Session:
         self.q = Queue()
         self.is_paused = True
         self.stopped = False
-        self.end_of_queue = True
+        # background work (e.g. playlist imports) owned by this session
+        self.tasks = set()
+        # link -> task resolving its stream url, for tracks about to play
+        self.prefetched = {}
+        # video id of the track playing on its retry after a 403, cleared when any other start happens
+        self.retried_video_id = None
+        # source of the next track, pre-spawned while the current one is ending
+        self.next_source = None
+        # player.Player driving playback, created on first use
+        self.player = None
+
+        # player.PlayerMessage showing the queue, created with the first message
+        self.player_message = None
+        # rendered queue text by key, valid for one queue version
+        self.rendered = {}
+        self.rendered_version = -1
+        self.last_active = time.monotonic()
+        # set by close(): a command that held on to the session while it awaited must not revive it
+        self.closed = False
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_for(self):
+        return time.monotonic() - self.last_active
+
+    def cached_render(self, key, build):
+        """Text for `key`, from build() the first time it's asked for since the queue last changed."""
+        if self.rendered_version != self.q.version or len(self.rendered) >= 64:
+            self.rendered.clear()
+            self.rendered_version = self.q.version
+        text = self.rendered.get(key)
+        if text is None:
+            text = self.rendered[key] = build()
+        return text
+
+    def cancel_tasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+        self.tasks.clear()
+
+    def cancel_prefetches(self):
+        for task in self.prefetched.values():
+            task.cancel()
+        self.prefetched.clear()
+
+    def take_next_source(self):
+        source, self.next_source = self.next_source, None
+        return source
+
+    def discard_next_source(self):
+        source = self.take_next_source()
+        if source:
+            source.cleanup()
+
+    def close(self):
+        """Stop everything the session runs in the background and drop its queue."""
+        self.closed = True
+        self.cancel_tasks()
+        self.cancel_prefetches()
+        if self.player:
+            self.player.close()
+            self.player = None
+        if self.player_message:
+            self.player_message.cancel()
+        self.discard_next_source()
+        self.q.clear_queue()
+
+
+class SessionRegistry:
+    """Sessions by guild id, then voice channel id, for O(1) lookups."""
+
+    def __init__(self):
+        self.by_guild = {}
+        self.next_id = 0
+        self.created = 0
+        self.removed = 0
+
+    def get(self, guild_id, channel_id):
+        return self.by_guild.get(guild_id, {}).get(channel_id)
+
+    def get_or_create(self, guild, channel):
+        channels = self.by_guild.setdefault(guild.id, {})
+        session = channels.get(channel.id)
+        if session is None:
+            session = channels[channel.id] = Session(guild, channel, id=self.next_id)
+            self.next_id += 1
+            self.created += 1
+        session.touch()
+        return session
+
+    def for_guild(self, guild_id):
+        return list(self.by_guild.get(guild_id, {}).values())
+
+    def remove(self, guild_id, channel_id):
+        """Close and forget a session, returns it (or None if there was none)."""
+        channels = self.by_guild.get(guild_id)
+        session = channels.pop(channel_id, None) if channels else None
+        if channels is not None and not channels:
+            del self.by_guild[guild_id]
+        if session:
+            session.close()
+            self.removed += 1
+        return session
+
+    def __iter__(self):
+        for channels in list(self.by_guild.values()):
+            yield from list(channels.values())
+
+    def __len__(self):
+        return sum(len(channels) for channels in self.by_guild.values())
 
-        self.player_message_id: int | None = None
-        self.player_channel_id: int | None = None
+    def report(self):
+        sessions = list(self)
+        return {
+            "sessions": len(sessions),
+            "guilds": len(self.by_guild),
+            "created": self.created,
+            "removed": self.removed,
+            "tracks": sum(len(session.q) for session in sessions),
+            "tasks": sum(len(session.tasks) + len(session.prefetched) for session in sessions),
+            "queue_bytes": sum(session.q.memory_usage() for session in sessions),
+            "message_edits": sum(session.player_message.edits for session in sessions if session.player_message),
+            "edits_skipped": sum(session.player_message.skipped for session in sessions if session.player_message),
+        }